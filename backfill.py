@@ -0,0 +1,67 @@
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Tuple
+
+
+class IncompleteFetchError(Exception):
+    """ Raised by a fetch which couldn't get the usage for some of its devices, so the window it was
+    fetching can be reported as failed rather than left with a gap. """
+
+    def __init__(self, device_ids: List[str], cause: Exception):
+        super().__init__(f'Unable to fetch usage for {len(device_ids)} device(s): {cause}')
+        self.device_ids = device_ids
+
+
+def split_window(since: int, until: int, window_seconds: int) -> List[Tuple[int, int]]:
+    """ Splits the period [since, until) into sub-windows whose boundaries fall on multiples of
+    window_seconds. The first and last windows may be shorter if since or until isn't aligned. """
+
+    windows = []
+    window_start = since
+    while window_start < until:
+        window_end = min(window_start - window_start % window_seconds + window_seconds, until)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+def run_backfill(fetch: Callable[[int, int], list], write: Callable[[list], None], since: int, until: int,
+                 window_seconds: int = 86400, concurrency: int = 4) -> List[Tuple[int, int]]:
+    """ Fetches the period [since, until) as a series of aligned sub-windows, with up to concurrency
+    windows being fetched at once. fetch(window_since, window_until) is called for each window, and
+    its results are passed to write() as soon as that window completes, so the whole period never
+    needs to be held in memory at once. A new window is only started once an earlier one has been
+    written, so at most concurrency windows' results are held at a time.
+
+    Returns the windows which failed to fetch. They are reported as they fail, but don't stop the
+    other windows from being fetched and written.
+    """
+
+    windows = split_window(since, until, window_seconds)
+    failed = []
+    completed = 0
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        to_start = iter(windows)
+        futures = {}
+        while True:
+            while len(futures) < concurrency and (window := next(to_start, None)) is not None:
+                futures[executor.submit(fetch, *window)] = window
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Dropping the future lets its results be freed once they're written
+                window_since, window_until = futures.pop(future)
+                completed += 1
+                try:
+                    rows = future.result()
+                except Exception as err:
+                    print(f'Unable to fetch {window_since} - {window_until}: {err}', file=sys.stderr)
+                    failed.append((window_since, window_until))
+                    continue
+                write(rows)
+                print(f'Backfilled {window_since} - {window_until} ({len(rows)} rows, {completed}/{len(windows)} windows, '
+                      f'{time.time() - start_time:.0f}s elapsed)', file=sys.stderr)
+    return sorted(failed)
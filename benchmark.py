@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import fake_partner_api
+import mysql_functions
+import settings
+import sinks
+import vced_stats
+import vced_stats_rest
+from inventory_cache import InventoryCache
+from partner_api2_pb2 import DataResolution
+from token_cache import TokenCache
+
+benchmarks = ['startup', 'grpc_transform', 'rest_transform', 'iso8601', 'iso8601_strptime', 'csv', 'db_write']
+# The modules imported by the startup benchmark, and the heavy modules which importing them shouldn't load
+startup_modules = ['mysql_functions', 'rollups', 'vced_stats', 'vced_stats_rest']
+heavy_modules = ['grpc', 'partner_api2_pb2', 'mysql.connector', 'requests', 'asyncio', 'http.server']
+# Used in place of config.json, so the results don't depend on the local settings and the benchmarks
+# run without one (in CI, say). Only the synthetic fleet is ever contacted.
+benchmark_config = {
+    'username': 'benchmark@example.com',
+    'password': 'benchmark',
+    'resolution': 'fifteen_minutes',
+}
+
+
+class LocalStub:
+    """ Calls the fake servicer in-process, in place of a PartnerApiStub. """
+
+    def __init__(self, servicer: fake_partner_api.FakePartnerApi):
+        self.servicer = servicer
+
+    def __getattr__(self, name: str):
+        method = getattr(self.servicer, name)
+        return lambda request, timeout=None: method(request, None)
+
+
+class LocalResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def use_fleet(fleet: fake_partner_api.Fleet) -> None:
+    """ Points both fetchers at the fleet, in-process, and loads their inventories from it. """
+
+    servicer = fake_partner_api.FakePartnerApi(fleet, fake_partner_api.Faults(), fake_partner_api.Tokens())
+    vced_stats._stub = LocalStub(servicer)
+    vced_stats._token_cache = TokenCache('benchmark', vced_stats.request_auth_token)
+    vced_stats._inventory = InventoryCache('benchmark', vced_stats.fetch_inventory)
+    vced_stats._inventory.device_ids()
+
+    def api_get(path: str, params: dict = None, stage: str = 'usage') -> LocalResponse:
+        if path == '/v1/partner/devices':
+            return LocalResponse({'devices': [{'device_id': device_id, 'category': 'MONITOR'} for device_id in fleet.device_ids]})
+        return LocalResponse({'success': [fake_partner_api.rest_energy_monitor(fleet, device_id) for device_id in params['device_ids']]})
+    vced_stats_rest.api_get = api_get
+    vced_stats_rest._inventory = InventoryCache('benchmark', vced_stats_rest.fetch_inventory)
+    vced_stats_rest._inventory.device_ids()
+
+
+def strptime_to_timestamp(iso8601_string: str) -> int:
+    """ How the REST fetcher used to parse timestamps, for comparison with its current codec. """
+
+    return int(datetime.datetime.strptime(iso8601_string, '%Y-%m-%dT%H:%M:%SZ').timestamp())
+
+
+def measure(run: Callable[[], Tuple[int, float]], repeat: int) -> dict:
+    """ Calls run(), which returns the number of rows it handled and the seconds spent on them,
+    repeat times for the best time, and once more under tracemalloc for the peak memory allocated. """
+
+    best_rows, best = 0, None
+    for _ in range(repeat):
+        gc.collect()
+        rows, elapsed = run()
+        if best is None or elapsed < best:
+            best_rows, best = rows, elapsed
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'rows': best_rows, 'seconds': best, 'rows_per_second': best_rows / best if best else 0, 'peak_mb': peak / 2 ** 20}
+
+
+def run_benchmarks(names: List[str], device_counts: List[int], hours: int, repeat: int) -> Dict[str, Dict[str, dict]]:
+    """ Runs each benchmark at each fleet size, printing the results as it goes. """
+
+    settings.config.use(benchmark_config)
+    results = {name: {} for name in names}
+    print(f"{'benchmark':<16}{'devices':>8}{'rows':>12}{'rows/s':>14}{'peak MB':>10}")
+    for devices in device_counts:
+        fleet = fake_partner_api.Fleet(devices, history_days=hours // 24 + 2)
+        use_fleet(fleet)
+        until = int(time.time()) - int(time.time()) % 900
+        since = until - hours * 3600
+        device_usages = fake_partner_api.usage_response(fleet, fleet.device_ids, since, until,
+                                                        DataResolution.FifteenMinutes).device_usages
+        batch = vced_stats.usage_to_batch(device_usages)
+
+        def grpc_transform() -> Tuple[int, float]:
+            start_time = time.perf_counter()
+            rows = len(vced_stats.usage_to_batch(device_usages))
+            return rows, time.perf_counter() - start_time
+
+        def rest_transform() -> Tuple[int, float]:
+            # The JSON for the whole fleet wouldn't fit in memory at the larger sizes, so each chunk of
+            # 100 devices is generated in turn and only the transform is timed
+            rows, elapsed = 0, 0.0
+            for position in range(0, devices, 100):
+                chunk = fake_partner_api.rest_usages(fleet, fleet.device_ids[position:position + 100], since, until, 900)
+                start_time = time.perf_counter()
+                rows += len(vced_stats_rest.usages_to_batch(chunk))
+                elapsed += time.perf_counter() - start_time
+            return rows, elapsed
+
+        def parse_interval_ends(parse: Callable[[str], int]) -> Tuple[int, float]:
+            # Parses the interval end of every sample, a chunk of 100 devices at a time like rest_transform
+            vced_stats_rest.iso8601_to_timestamp.cache_clear()
+            rows, elapsed = 0, 0.0
+            for position in range(0, devices, 100):
+                chunk = fake_partner_api.rest_usages(fleet, fleet.device_ids[position:position + 100], since, until, 900)
+                ends = [usage['interval']['end'] for device in chunk for circuit in device['circuit_usages']
+                        for usage in circuit['usage']]
+                start_time = time.perf_counter()
+                for end in ends:
+                    parse(end)
+                elapsed += time.perf_counter() - start_time
+                rows += len(ends)
+            return rows, elapsed
+
+        def csv() -> Tuple[int, float]:
+            start_time = time.perf_counter()
+            with sinks.CsvSink(os.devnull) as output:
+                output.write(batch)
+            return len(batch), time.perf_counter() - start_time
+
+        def db_write() -> Tuple[int, float]:
+            with tempfile.TemporaryDirectory() as directory:
+                mysql_functions._backend = mysql_functions.SQLiteBackend(os.path.join(directory, 'benchmark.sqlite3'))
+                try:
+                    start_time = time.perf_counter()
+                    rows = mysql_functions.write_to_db(batch)['written']
+                    return rows, time.perf_counter() - start_time
+                finally:
+                    mysql_functions._backend = None
+
+        runs = {'grpc_transform': grpc_transform, 'rest_transform': rest_transform, 'csv': csv, 'db_write': db_write,
+                'iso8601': lambda: parse_interval_ends(vced_stats_rest.iso8601_to_timestamp),
+                'iso8601_strptime': lambda: parse_interval_ends(strptime_to_timestamp)}
+        for name in names:
+            result = results[name][str(devices)] = measure(runs[name], repeat)
+            print(f"{name:<16}{devices:>8}{result['rows']:>12}{result['rows_per_second']:>14.0f}{result['peak_mb']:>10.1f}")
+        del device_usages, batch
+    return results
+
+
+def run_startup(repeat: int) -> Dict[str, dict]:
+    """ Times importing each of the startup modules in a fresh interpreter, keeping the best of repeat
+    runs. Also records whether the import read config.json or loaded any of the heavy modules, neither
+    of which it should. """
+
+    code = ('import json, sys, time\n'
+            'start_time = time.perf_counter()\n'
+            'import {module}\n'
+            'seconds = time.perf_counter() - start_time\n'
+            'import settings\n'
+            'print(json.dumps({{"seconds": seconds, "config_read": settings.config.loaded(), '
+            '"heavy_imports": [name for name in {heavy} if name in sys.modules]}}))')
+    results = {}
+    print(f"{'startup':<16}{'module':>16}{'ms':>10}  loaded")
+    for module in startup_modules:
+        best = None
+        for _ in range(repeat):
+            child = subprocess.run([sys.executable, '-c', code.format(module=module, heavy=heavy_modules)],
+                                   capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            result = json.loads(child.stdout)
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results[module] = best
+        loaded = best['heavy_imports'] + (['config.json'] if best['config_read'] else [])
+        print(f"{'':<16}{module:>16}{best['seconds'] * 1000:>10.1f}  {', '.join(loaded) or '-'}")
+    return results
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(previous: dict, current: dict, threshold: float) -> bool:
+    """ Prints the change in throughput from the previous results. Returns whether anything got
+    slower by more than threshold (a fraction). """
+
+    print(f"\nCompared with {previous['commit']}:")
+    regressed = False
+    for name, sizes in current['results'].items():
+        for devices, result in sizes.items():
+            before = previous['results'].get(name, {}).get(devices)
+            if not before or not before['rows_per_second']:
+                continue
+            change = result['rows_per_second'] / before['rows_per_second'] - 1
+            flag = ''
+            if change < -threshold:
+                flag = '  <-- slower'
+                regressed = True
+            print(f"{name:<16}{devices:>8}{before['rows_per_second']:>14.0f} -> {result['rows_per_second']:<14.0f}{change:+.1%}{flag}")
+    for module, result in current.get('startup', {}).items():
+        before = previous.get('startup', {}).get(module)
+        if not before:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  <-- slower'
+            regressed = True
+        print(f"{'startup':<16}{module:>16}{before['seconds'] * 1000:>8.1f}ms -> {result['seconds'] * 1000:.1f}ms  {change:+.1%}{flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the per-row hot paths on synthetic payloads: the gRPC and REST '
+                                                 'transforms, CSV rendering and writing to a local SQLite database. '
+                                                 'Also times importing the fetchers (startup).')
+    parser.add_argument('--benchmark', action='append', choices=benchmarks, dest='benchmarks',
+                        help='Only run this benchmark. May be given more than once. (Default all.)')
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='The fleet sizes to run at. Default 10 100 1000 10000.')
+    parser.add_argument('--hours', type=int, default=4, help='Hours of 15-minute usage per device. Default 4.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark; the best time is kept. Default 3.')
+    parser.add_argument('--output', help='Save the results to this file. Default benchmark_results/COMMIT.json.')
+    parser.add_argument('--compare', metavar='RESULTS', help='Compare with results saved by an earlier run.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='With --compare, exit with status 1 if anything is this fraction slower. Default 0.1.')
+    args = parser.parse_args()
+
+    names = args.benchmarks or benchmarks
+    results = {'commit': git_commit(),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'time': int(time.time()),
+               'hours': args.hours}
+    if 'startup' in names:
+        results['startup'] = run_startup(args.repeat)
+        print()
+    fleet_names = [name for name in names if name != 'startup']
+    results['results'] = run_benchmarks(fleet_names, args.devices, args.hours, args.repeat) if fleet_names else {}
+
+    output_path = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results',
+                                              f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'\nSaved the results to {output_path}')
+
+    if args.compare:
+        with open(args.compare, 'r') as previous_file:
+            if compare(json.load(previous_file), results, args.threshold):
+                sys.exit(1)
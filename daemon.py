@@ -0,0 +1,45 @@
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import Callable
+
+
+def run_daemon(run_cycle: Callable[[], None], interval: int = 900, delay: int = 60) -> bool:
+    """ Calls run_cycle() straight away, and then delay seconds after every multiple of interval
+    seconds (by default, a minute after each 15-minute bucket ends, giving the API time to close the
+    bucket). An exception from a cycle is reported and the next cycle runs as normal.
+
+    Runs until SIGTERM or SIGINT is received, or SIGHUP. A cycle in progress is allowed to finish.
+    Returns True if stopped by SIGHUP, so the caller can reload its config and start again.
+    """
+
+    stop = threading.Event()
+    reload_requested = False
+
+    def handle_stop(signum, frame):
+        stop.set()
+
+    def handle_reload(signum, frame):
+        nonlocal reload_requested
+        reload_requested = True
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, handle_reload)
+
+    while not stop.is_set():
+        try:
+            run_cycle()
+        except Exception:
+            print('Cycle failed, will try again next cycle:', file=sys.stderr)
+            traceback.print_exc()
+
+        now = time.time()
+        next_run = now - (now - delay) % interval + interval
+        stop.wait(next_run - now)
+
+    return reload_requested
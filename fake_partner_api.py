@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import random
+import secrets
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import grpc
+
+import partner_api2_pb2_grpc as api
+from partner_api2_pb2 import *
+
+# The length of each DataResolution bucket, for the resolutions the fetchers use
+bucket_seconds = {DataResolution.Minutes: 60, DataResolution.FifteenMinutes: 900, DataResolution.Hours: 3600}
+rest_bucket_seconds = {'MINUTES': 60, 'FIFTEEN_MINUTES': 900, 'HOURS': 3600}
+Device = DeviceInventoryResponse.Device
+timezones = ['America/New_York', 'America/Chicago', 'America/Denver', 'America/Los_Angeles', 'UTC', 'Asia/Kolkata']
+
+
+class Fleet:
+    """ A synthetic fleet of energy monitors. Each device has 3 mains and a number of branch circuits,
+    and its usage is a deterministic function of the device, channel and time, so repeated and
+    overlapping fetches agree with each other. Usage is only available for the last history_days
+    days. """
+
+    def __init__(self, devices: int = 100, circuits: int = 16, history_days: int = 30):
+        self.device_ids = [f'FAKE{index:08d}' for index in range(devices)]
+        self.device_indexes = {device_id: index for index, device_id in enumerate(self.device_ids)}
+        self.circuits = circuits
+        self.history_days = history_days
+
+    def timezone(self, device_id: str) -> str:
+        return timezones[self.device_indexes[device_id] % len(timezones)]
+
+    def channels(self) -> List[int]:
+        return list(range(1, 4 + self.circuits))
+
+    def buckets(self, start: int, end: int, seconds: int, in_progress: bool = False) -> List[int]:
+        """ Returns the start of each bucket overlapping [start, end) which is within the history. The
+        bucket which hasn't finished yet is only included if in_progress is set. """
+
+        now = int(time.time())
+        first = max(start, now - self.history_days * 86400)
+        first -= first % seconds
+        last = now if in_progress else now - seconds + 1
+        return list(range(first, min(end, last), seconds))
+
+    def usage(self, device_id: str, channel: int, bucket: int, seconds: int) -> float:
+        """ The usage in watt-hours. Mains use 100-1100 W, branch circuits 0-500 W. """
+
+        seed = (self.device_indexes.get(device_id, 0) * 7919 + channel * 104729 + bucket // seconds) % 1000
+        watts = 100 + seed if channel < 4 else seed / 2
+        return watts * seconds / 3600
+
+
+class Faults:
+    """ The latency and errors to inject into each request. """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+
+    def delay(self) -> None:
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def error(self) -> bool:
+        return random.random() < self.error_rate
+
+    def throttle(self) -> bool:
+        return random.random() < self.throttle_rate
+
+
+class Tokens:
+    """ The auth tokens which have been issued, and when each one expires. """
+
+    def __init__(self, lifetime: int = 3600):
+        self.lifetime = lifetime
+        self._expiry: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def issue(self) -> str:
+        token = secrets.token_hex(16)
+        with self._lock:
+            self._expiry[token] = time.time() + self.lifetime
+        return token
+
+    def valid(self, token: str) -> bool:
+        with self._lock:
+            return self._expiry.get(token, 0) > time.time()
+
+
+def usage_response(fleet: Fleet, device_ids: List[str], start: int, end: int, scale: int,
+                   channels: List[int] = None) -> DeviceUsageResponse:
+    """ Builds the GetUsageData response for some of the fleet's devices. """
+
+    seconds = bucket_seconds[scale]
+    buckets = fleet.buckets(start, end, seconds)
+    response = DeviceUsageResponse()
+    for device_id in device_ids:
+        if device_id not in fleet.device_indexes:
+            continue
+        device_usage = response.device_usages.add(manufacturer_device_id=device_id, scale=scale, bucket_epoch_seconds=buckets)
+        for channel in channels or fleet.channels():
+            device_usage.channel_usages.add(channel=channel,
+                                            usages=[fleet.usage(device_id, channel, bucket, seconds) for bucket in buckets])
+    return response
+
+
+class FakePartnerApi(api.PartnerApiServicer):
+    """ Implements the parts of the gRPC Partner API used by vced_stats.py. """
+
+    def __init__(self, fleet: Fleet, faults: Faults, tokens: Tokens):
+        self.fleet = fleet
+        self.faults = faults
+        self.tokens = tokens
+
+    def _check(self, context, auth_token: str = None) -> None:
+        self.faults.delay()
+        if self.faults.throttle():
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'Rate limit exceeded')
+        if self.faults.error():
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'Injected failure')
+        if auth_token is not None and not self.tokens.valid(auth_token):
+            context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Invalid auth_token')
+
+    def Authenticate(self, request, context):
+        self._check(context)
+        return AuthenticationResponse(auth_token=self.tokens.issue())
+
+    def GetDevices(self, request, context):
+        self._check(context, request.auth_token)
+        response = DeviceInventoryResponse()
+        for device_id in self.fleet.device_ids:
+            device = response.devices.add(manufacturer_device_id=device_id, model=Device.DeviceModel.Vue2,
+                                          timezone=self.fleet.timezone(device_id), device_connected=True)
+            for channel in self.fleet.channels():
+                device.circuit_infos.add(
+                    channel_number=channel,
+                    type=Device.CircuitInfo.Vue_200A_Main if channel < 4 else Device.CircuitInfo.Vue_50A_Expansion,
+                    energy_direction=Device.CircuitInfo.Consumption,
+                    sub_type='' if channel < 4 or channel % 3 else 'AirConditioner')
+        return response
+
+    def GetUsageData(self, request, context):
+        self._check(context, request.auth_token)
+        if request.scale not in bucket_seconds:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'Unsupported scale')
+        channels = self.fleet.channels() if request.channels == DeviceUsageRequest.UsageChannel.ALL else [1, 2, 3]
+
+        return usage_response(self.fleet, request.manufacturer_device_ids, request.start_epoch_seconds,
+                              request.end_epoch_seconds, request.scale, channels)
+
+
+def iso8601(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_iso8601(value: str) -> int:
+    return int(datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def rest_circuit_ids(fleet: Fleet) -> List[str]:
+    return ['Main_1', 'Main_2', 'Main_3'] + [str(number) for number in range(1, fleet.circuits + 1)]
+
+
+def rest_energy_monitor(fleet: Fleet, device_id: str) -> dict:
+    """ Builds the energy-monitors response entry for one of the fleet's devices. """
+
+    circuits = []
+    for circuit_id in rest_circuit_ids(fleet):
+        main = circuit_id.startswith('Main_')
+        circuits.append({'circuit_id': circuit_id,
+                         'circuit_type': 'MAIN' if main else 'BRANCH',
+                         'circuit_sub_type': None if main or int(circuit_id) % 3 else 'AIR_CONDITIONER',
+                         'energy_direction': 'CONSUMPTION',
+                         'multiplier': 1.0})
+    return {'device_id': device_id, 'timezone': fleet.timezone(device_id), 'circuits': circuits}
+
+
+def rest_usages(fleet: Fleet, device_ids: List[str], start: int, end: int, seconds: int,
+                circuit_ids: List[str] = None) -> List[dict]:
+    """ Builds the usages response entries for some of the fleet's devices. """
+
+    requested = set(circuit_ids or rest_circuit_ids(fleet))
+    now = time.time()
+    results = []
+    for device_id in device_ids:
+        circuit_usages = []
+        for circuit_id in rest_circuit_ids(fleet):
+            if circuit_id not in requested:
+                continue
+            channel = int(circuit_id[5:]) if circuit_id.startswith('Main_') else int(circuit_id) + 3
+            # Unlike gRPC, the bucket which is still in progress is included, marked as partial
+            usage = [{'interval': {'start': iso8601(bucket), 'end': iso8601(bucket + seconds)},
+                      'energy_kwhs': fleet.usage(device_id, channel, bucket, seconds) / 1000,
+                      'partial': bucket + seconds > now}
+                     for bucket in fleet.buckets(start, end, seconds, in_progress=True)]
+            circuit_usages.append({'circuit_id': circuit_id, 'usage': usage})
+        results.append({'device_id': device_id, 'circuit_usages': circuit_usages})
+    return results
+
+
+def rest_handler(fleet: Fleet, faults: Faults, tokens: Tokens):
+    """ Returns a request handler class implementing the Cognito token endpoint and the REST API
+    endpoints used by vced_stats_rest.py. """
+
+    def device_ids(query: dict) -> List[str]:
+        ids = query.get('device_ids', [])
+        if len(ids) > 100:
+            raise ValueError('At most 100 device_ids are allowed')
+        return [device_id for device_id in ids if device_id in fleet.device_indexes]
+
+    class FakeRestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, body: dict, headers: dict = None) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def injected_fault(self) -> bool:
+            faults.delay()
+            if faults.throttle():
+                self.send_json(429, {'message': 'Too Many Requests'}, {'Retry-After': str(faults.retry_after)})
+                return True
+            if faults.error():
+                self.send_json(503, {'message': 'Injected failure'})
+                return True
+            return False
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.injected_fault():
+                return
+            if urlparse(self.path).path != '/oauth2/token':
+                self.send_json(404, {'message': 'Not Found'})
+                return
+            self.send_json(200, {'access_token': tokens.issue(), 'expires_in': tokens.lifetime, 'token_type': 'Bearer'})
+
+        def do_GET(self):
+            if self.injected_fault():
+                return
+            if not tokens.valid(self.headers.get('Authorization', '')):
+                self.send_json(401, {'message': 'Unauthorized'})
+                return
+
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            try:
+                if url.path == '/v1/partner/devices':
+                    self.send_json(200, {'devices': [{'device_id': device_id, 'category': 'MONITOR'}
+                                                     for device_id in fleet.device_ids]})
+                elif url.path == '/v1/devices/energy-monitors':
+                    self.send_json(200, {'success': [rest_energy_monitor(fleet, device_id) for device_id in device_ids(query)]})
+                elif url.path == '/v1/devices/energy-monitors/circuits/usages/energy':
+                    self.send_json(200, {'success': rest_usages(fleet, device_ids(query), parse_iso8601(query['start'][0]),
+                                                                parse_iso8601(query['end'][0]),
+                                                                rest_bucket_seconds[query['energy_resolution'][0]],
+                                                                query.get('circuit_ids'))})
+                else:
+                    self.send_json(404, {'message': 'Not Found'})
+            except (KeyError, ValueError) as err:
+                self.send_json(400, {'message': str(err)})
+
+    return FakeRestHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs local stand-ins for the Emporia gRPC Partner API and REST API, '
+                                                 'serving a synthetic fleet, for testing the fetchers offline.')
+    parser.add_argument('--grpc-port', type=int, default=50052, help='Port for the gRPC API (0 to not run it). Default 50052.')
+    parser.add_argument('--rest-port', type=int, default=8080,
+                        help='Port for the REST API and token endpoint (0 to not run it). Default 8080.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default 127.0.0.1.')
+    parser.add_argument('--devices', type=int, default=100, help='Number of devices in the fleet. Default 100.')
+    parser.add_argument('--circuits', type=int, default=16, help='Branch circuits per device, besides the 3 mains. Default 16.')
+    parser.add_argument('--history-days', type=int, default=30, help='How many days of usage are available. Default 30.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many random seconds added to every request.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests which fail (UNAVAILABLE over gRPC, 503 over REST).')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of requests which are rate limited (RESOURCE_EXHAUSTED over gRPC, 429 over REST).')
+    parser.add_argument('--retry-after', type=int, default=1, help='The Retry-After seconds sent with a 429. Default 1.')
+    parser.add_argument('--token-lifetime', type=int, default=3600, help='Seconds before auth tokens expire. Default 3600.')
+    parser.add_argument('--workers', type=int, default=16, help='gRPC server threads. Default 16.')
+    args = parser.parse_args()
+
+    fleet = Fleet(args.devices, args.circuits, args.history_days)
+    faults = Faults(args.latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after)
+    tokens = Tokens(args.token_lifetime)
+
+    if args.grpc_port:
+        grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.workers))
+        api.add_PartnerApiServicer_to_server(FakePartnerApi(fleet, faults, tokens), grpc_server)
+        grpc_server.add_insecure_port(f'{args.host}:{args.grpc_port}')
+        grpc_server.start()
+        print(f'gRPC API on {args.host}:{args.grpc_port} (set "api_root", "api_port" and "grpc_insecure": true)')
+    if args.rest_port:
+        rest_server = ThreadingHTTPServer((args.host, args.rest_port), rest_handler(fleet, faults, tokens))
+        threading.Thread(target=rest_server.serve_forever, daemon=True).start()
+        print(f'REST API on http://{args.host}:{args.rest_port} (set "rest_api_root" and "cognito_domain" to it)')
+    print(f'Serving {args.devices} devices with {args.circuits + 3} circuits each. Ctrl-C to stop.')
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
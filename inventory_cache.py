@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class InventoryCache:
+    """ Holds the circuit metadata for every device on the account, indexed by (device_id, channel_id),
+    so each usage sample can be matched with its circuit in constant time.
+
+    fetch() is called to load the inventory from the API and must return a list of circuit dicts,
+    each with at least 'device_id' and 'channel_id' keys. The inventory is refetched once it is older
+    than ttl seconds, or when a lookup misses (a device or circuit was added since it was fetched)
+    and it is older than refresh_interval seconds. If a path is given, the inventory is kept in that
+    file between runs, keyed by name.
+    """
+
+    def __init__(self, name: str, fetch: Callable[[], List[dict]], path: str = None, ttl: int = 86400,
+                 refresh_interval: int = 600):
+        self.name = name
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._circuits: Dict[Tuple[str, int], dict] = {}
+        self._device_ids: List[str] = []
+        self._device_channels: Dict[str, List[int]] = {}
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+
+    def device_ids(self) -> List[str]:
+        """ Returns the IDs of all the devices in the inventory, in the order the API listed them. """
+
+        with self._lock:
+            self._load()
+            return list(self._device_ids)
+
+    def timezones(self) -> Dict[str, str]:
+        """ Returns the timezone of each device, for the devices whose circuits have a 'timezone'. """
+
+        with self._lock:
+            self._load()
+            return {circuit['device_id']: circuit['timezone'] for circuit in self._circuits.values() if circuit.get('timezone')}
+
+    def channel_ids(self, device_ids: List[str]) -> List[int]:
+        """ Returns the channel IDs found on any of the given devices, in ascending order. """
+
+        with self._lock:
+            self._load()
+            return sorted({channel_id for device_id in device_ids for channel_id in self._device_channels.get(device_id, [])})
+
+    def get_circuit_info(self, device_id: str, channel_id: int) -> Optional[dict]:
+        """ Returns the metadata for a device channel. If it isn't known, the inventory is refetched
+        (unless it was fetched less than refresh_interval seconds ago). Returns None if the channel
+        still isn't known. """
+
+        with self._lock:
+            self._load()
+            circuit = self._circuits.get((device_id, channel_id))
+            if circuit is None and time.time() > self._fetched_at + self.refresh_interval:
+                self._refresh()
+                circuit = self._circuits.get((device_id, channel_id))
+        return circuit
+
+    def _load(self) -> None:
+        if not self._fetched_at and self.path:
+            entry = self._read_file().get(self.name)
+            if entry:
+                self._index(entry['circuits'], entry['fetched_at'])
+        if time.time() > self._fetched_at + self.ttl:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        self._index(self.fetch(), time.time())
+        if self.path:
+            self._write_file()
+
+    def _index(self, circuits: List[dict], fetched_at: float) -> None:
+        self._circuits = {(circuit['device_id'], circuit['channel_id']): circuit for circuit in circuits}
+        # dict.fromkeys() removes the duplicates while keeping the order
+        self._device_ids = list(dict.fromkeys(circuit['device_id'] for circuit in circuits))
+        self._device_channels = {}
+        for device_id, channel_id in self._circuits:
+            self._device_channels.setdefault(device_id, []).append(channel_id)
+        self._fetched_at = fetched_at
+
+    def _read_file(self) -> dict:
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_file(self) -> None:
+        inventories = self._read_file()
+        inventories[self.name] = {'fetched_at': self._fetched_at, 'circuits': list(self._circuits.values())}
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(inventories, cache_file)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+# The metrics which are recorded, with their Prometheus type and help text
+definitions = {
+    'emporia_stage_seconds': ('histogram', 'Time taken by each call of a stage. The usage, transform and db_batch '
+                                           'stages are called once per chunk.'),
+    'emporia_stage_errors_total': ('counter', 'Calls of a stage which raised an error.'),
+    'emporia_bytes_received_total': ('counter', 'Bytes of API responses received, by stage.'),
+    'emporia_rows_total': ('counter', 'Usage rows produced from API responses (or skipped, for circuits missing from the '
+                                      'inventory), and inserted, ignored (already present) or failed when written to the database.'),
+    'emporia_request_retries_total': ('counter', 'Requests retried after being rate limited or failing, by reason.'),
+    'emporia_request_splits_total': ('counter', 'gRPC usage requests split in two because the response was too large or too slow.'),
+    'emporia_scheduler_concurrency': ('gauge', 'How many requests the adaptive scheduler currently allows in flight.'),
+    'emporia_scheduler_chunk_size': ('gauge', 'How many devices the adaptive scheduler currently puts in each request.'),
+    'emporia_runs_total': ('counter', 'Fetch runs (or daemon cycles), by outcome.'),
+    'emporia_last_run_seconds': ('gauge', 'How long the most recent run took.'),
+    'emporia_last_success_timestamp_seconds': ('gauge', 'When the most recent successful run finished.'),
+}
+# The upper bounds of the histogram buckets, in seconds
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+# Each value is keyed by the metric name and its labels (as a sorted tuple of pairs)
+_values: Dict[Tuple[str, tuple], float] = {}
+# Histograms hold a count per bucket (plus +Inf), the sum and the count
+_histograms: Dict[Tuple[str, tuple], list] = {}
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """ Adds to a counter. """
+
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _values[(name, tuple(sorted(labels.items())))] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """ Records a value in a histogram. """
+
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        for position, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][position] += 1
+                break
+        else:
+            histogram[0][-1] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextmanager
+def timed(stage: str):
+    """ Records how long the block takes in emporia_stage_seconds, and counts it in
+    emporia_stage_errors_total if it raises. """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc('emporia_stage_errors_total', stage=stage)
+        raise
+    finally:
+        observe('emporia_stage_seconds', time.perf_counter() - start_time, stage=stage)
+
+
+@contextmanager
+def run(textfile: str = None):
+    """ Records the outcome and duration of a fetch run (or daemon cycle), then writes all the metrics
+    to textfile, if given. """
+
+    start_time = time.time()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+        set_gauge('emporia_last_success_timestamp_seconds', time.time())
+    finally:
+        inc('emporia_runs_total', outcome=outcome)
+        set_gauge('emporia_last_run_seconds', time.time() - start_time)
+        if textfile:
+            write_textfile(textfile)
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = ((name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render() -> str:
+    """ Returns all the metrics in the Prometheus text exposition format. """
+
+    lines = []
+    with _lock:
+        for name, (metric_type, help_text) in definitions.items():
+            values = sorted((labels, value) for (metric_name, labels), value in _values.items() if metric_name == name)
+            histograms = sorted((labels, histogram) for (metric_name, labels), histogram in _histograms.items()
+                                if metric_name == name)
+            if not values and not histograms:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in values:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            for labels, (counts, total, count) in histograms:
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path: str) -> None:
+    """ Writes the metrics to a file for the node_exporter textfile collector. The file is replaced
+    atomically, so the collector never reads a partly written file. """
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as metrics_file:
+        metrics_file.write(render())
+    os.replace(temp_path, path)
+
+
+def serve(port: int, host: str = ''):
+    """ Serves the metrics over HTTP on the given port, from a background thread. Returns the
+    ThreadingHTTPServer. """
+
+    # Only the daemon serves metrics, so the HTTP server isn't imported until it is needed
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
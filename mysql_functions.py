@@ -1,50 +1,665 @@
-import json
+import math
 import os
-import pathlib
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
-from contextlib import closing
-from typing import List
+from array import array
+from contextlib import closing, nullcontext
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Tuple, Union
 
-import mysql.connector
+import metrics
+import schema
+from settings import config
+from usage_batch import UsageBatch, row_columns, to_batch
 
-config_path = os.path.normpath(os.path.join(pathlib.Path(__file__).parent.resolve(), 'config.json'))
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
+# The columns of usage_data, in the order the values are sent to the server
+usage_columns = row_columns
+# The columns of usage_minutes, which holds an hour of per-minute readings in each row
+minute_columns = ['device_id', 'channel_id', 'channel_type', 'channel_direction', 'hour', 'usages']
 
+# The connection pool is created on first use and shared by every function in this module
+_pool = None
+_pool_connections = 0
+_pool_lock = threading.Lock()
 
-def write_to_db(values: List[dict]) -> None:
-    with closing(mysql.connector.connect(**config['db'])) as conn:
+
+def get_connection():
+    """ Returns a connection from the shared connection pool. The connection is pinged before it is
+    handed out, and reconnected if the server has dropped it while it sat idle in the pool.
+    Closing the connection returns it to the pool rather than disconnecting.
+
+    Connections are only opened as they are needed, up to 'db_pool_size' (default 4). If they are
+    all in use, this waits up to 'db_pool_timeout' seconds (default 30) for one to be returned.
+    """
+
+    # Only installs which store to MySQL need the connector
+    import mysql.connector
+    from mysql.connector import pooling
+
+    global _pool, _pool_connections
+    with _pool_lock:
+        if _pool is None:
+            _pool = pooling.MySQLConnectionPool(pool_name='emporia_data_fetcher',
+                                                pool_size=config.get('db_pool_size', 4))
+            # Configuring the pool separately keeps it from opening every connection up front. LOAD DATA
+            # LOCAL INFILE (see bulk_load()) may only read files from the bulk load directory.
+            _pool.set_config(**{'allow_local_infile_in_path': bulk_load_dir(),
+                                **{key: value for key, value in config['db'].items() if key != 'backend'}})
+
+    give_up_at = time.time() + config.get('db_pool_timeout', 30)
+    while True:
+        try:
+            conn = _pool.get_connection()
+            break
+        except pooling.PoolError:
+            with _pool_lock:
+                if _pool_connections < _pool.pool_size:
+                    _pool.add_connection()
+                    _pool_connections += 1
+                    continue
+            if time.time() > give_up_at:
+                raise
+            time.sleep(0.05)
+
+    try:
+        conn.ping(reconnect=True, attempts=3, delay=1)
+    except mysql.connector.Error:
+        conn.close()
+        raise
+    return conn
+
+
+class MySQLBackend:
+    """ Stores usage in a MySQL server, using the shared connection pool. """
+
+    placeholder = '%s'
+    insert_statement = f"INSERT IGNORE INTO usage_data ({', '.join(usage_columns)}) VALUES ({', '.join(['%s'] * len(usage_columns))});"
+    # Tracks the newest timestamp stored for each device channel, so working out what to fetch next
+    # doesn't require scanning usage_data
+    watermark_statement = ('INSERT INTO usage_watermarks (device_id, channel_id, last_timestamp) VALUES (%s, %s, %s) '
+                           'ON DUPLICATE KEY UPDATE last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp));')
+    minute_statement = (f"INSERT INTO usage_minutes ({', '.join(minute_columns)}) VALUES ({', '.join(['%s'] * len(minute_columns))}) "
+                        'ON DUPLICATE KEY UPDATE usages = VALUES(usages);')
+    # Tracks how far each device has been fetched, even when nothing came back, so a gap in its data
+    # doesn't stop it from catching up
+    fetched_statement = ('INSERT INTO fetch_progress (device_id, fetched_until) VALUES (%s, %s) '
+                         'ON DUPLICATE KEY UPDATE fetched_until = GREATEST(fetched_until, VALUES(fetched_until));')
+
+    def __init__(self):
+        self._tables_checked = False
+        self._partitions_checked_at = 0
+        # Whether bulk_load() can be used, once known (see allows_bulk_load())
+        self.bulk_load_allowed = None
+
+    def connection(self):
+        """ Returns a context manager giving a connection, which goes back to the pool afterwards. """
+
+        return closing(get_connection())
+
+    def allows_bulk_load(self) -> bool:
+        """ Whether the server allows LOAD DATA LOCAL INFILE, which MySQL 8 turns off by default
+        (local_infile=OFF). Only checked the first time. """
+
+        if self.bulk_load_allowed is None:
+            with self.connection() as conn:
+                with closing(conn.cursor()) as cur:
+                    cur.execute('SELECT @@GLOBAL.local_infile;')
+                    self.bulk_load_allowed = bool(int(cur.fetchone()[0]))
+            if not self.bulk_load_allowed:
+                print('The MySQL server has local_infile=OFF, so large writes are inserted rather than bulk loaded',
+                      file=sys.stderr)
+        return self.bulk_load_allowed
+
+    def create_tables(self, cur) -> None:
+        """ Creates usage_data (see schema.py), and the usage_watermarks, fetch_progress and usage_minutes
+        tables, if they don't exist yet. The first time usage_watermarks is created on a database which already
+        has data, it is seeded from usage_data (a one-off full scan). The monthly partitions of
+        usage_data are kept up to date, checking at most once a day. """
+
+        if time.time() > self._partitions_checked_at + 86400:
+            self._partitions_checked_at = time.time()
+            try:
+                schema.create_usage_data(cur)
+                added, dropped = schema.maintain_partitions(cur)
+                if added or dropped:
+                    print(f"Added the usage_data partitions {', '.join(added) or 'none'}, dropped {', '.join(dropped) or 'none'}",
+                          file=sys.stderr)
+            except Exception as err:
+                # Another process may be doing the same; it's checked again tomorrow either way
+                print(f'Unable to update the usage_data partitions: {err}', file=sys.stderr)
+        if self._tables_checked:
+            return
+
+        cur.execute('CREATE TABLE IF NOT EXISTS usage_minutes (device_id VARCHAR(64) NOT NULL, channel_id INT NOT NULL, '
+                    'channel_type VARCHAR(64), channel_direction INT, hour BIGINT NOT NULL, usages BINARY(240) NOT NULL, '
+                    'PRIMARY KEY (device_id, channel_id, hour));')
+        cur.execute('CREATE TABLE IF NOT EXISTS fetch_progress (device_id VARCHAR(64) NOT NULL PRIMARY KEY, '
+                    'fetched_until BIGINT NOT NULL);')
+
+        cur.execute("SHOW TABLES LIKE 'usage_watermarks';")
+        if not cur.fetchall():
+            cur.execute('CREATE TABLE usage_watermarks (device_id VARCHAR(64) NOT NULL, channel_id INT NOT NULL, '
+                        'last_timestamp BIGINT NOT NULL, PRIMARY KEY (device_id, channel_id));')
+            cur.execute('INSERT INTO usage_watermarks (device_id, channel_id, last_timestamp) '
+                        'SELECT device_id, channel_id, max(timestamp) FROM usage_data GROUP BY device_id, channel_id;')
+        self._tables_checked = True
+
+
+class SQLiteBackend:
+    """ Stores usage in a local SQLite database file, for installs without a MySQL server. The database
+    uses write-ahead logging so readers don't block the writer, and each thread keeps its own
+    connection open for reuse. The tables are created on first use. """
+
+    placeholder = '?'
+    insert_statement = f"INSERT OR IGNORE INTO usage_data ({', '.join(usage_columns)}) VALUES ({', '.join(['?'] * len(usage_columns))});"
+    watermark_statement = ('INSERT INTO usage_watermarks (device_id, channel_id, last_timestamp) VALUES (?, ?, ?) '
+                           'ON CONFLICT (device_id, channel_id) DO UPDATE SET last_timestamp = max(last_timestamp, excluded.last_timestamp);')
+    minute_statement = (f"INSERT INTO usage_minutes ({', '.join(minute_columns)}) VALUES ({', '.join(['?'] * len(minute_columns))}) "
+                        'ON CONFLICT (device_id, channel_id, hour) DO UPDATE SET usages = excluded.usages;')
+    fetched_statement = ('INSERT INTO fetch_progress (device_id, fetched_until) VALUES (?, ?) '
+                         'ON CONFLICT (device_id) DO UPDATE SET fetched_until = max(fetched_until, excluded.fetched_until);')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._tables_checked = False
+
+    def connection(self):
+        """ Returns a context manager giving this thread's connection, which stays open afterwards. """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL;')
+            # With WAL, NORMAL only risks the most recent transactions on power loss, never corruption
+            conn.execute('PRAGMA synchronous=NORMAL;')
+            self._local.conn = conn
+        return nullcontext(conn)
+
+    def create_tables(self, cur) -> None:
+        if self._tables_checked:
+            return
+
+        cur.execute('CREATE TABLE IF NOT EXISTS usage_data (device_id TEXT NOT NULL, channel_id INTEGER NOT NULL, '
+                    'channel_type TEXT, channel_direction INTEGER, channel_usage REAL, timestamp INTEGER NOT NULL, '
+                    'PRIMARY KEY (device_id, channel_id, timestamp)) WITHOUT ROWID;')
+        cur.execute('CREATE INDEX IF NOT EXISTS usage_data_timestamp ON usage_data (timestamp);')
+        cur.execute('CREATE TABLE IF NOT EXISTS usage_minutes (device_id TEXT NOT NULL, channel_id INTEGER NOT NULL, '
+                    'channel_type TEXT, channel_direction INTEGER, hour INTEGER NOT NULL, usages BLOB NOT NULL, '
+                    'PRIMARY KEY (device_id, channel_id, hour)) WITHOUT ROWID;')
+        cur.execute('CREATE TABLE IF NOT EXISTS fetch_progress (device_id TEXT NOT NULL PRIMARY KEY, '
+                    'fetched_until INTEGER NOT NULL) WITHOUT ROWID;')
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'usage_watermarks';")
+        if not cur.fetchall():
+            cur.execute('CREATE TABLE usage_watermarks (device_id TEXT NOT NULL, channel_id INTEGER NOT NULL, '
+                        'last_timestamp INTEGER NOT NULL, PRIMARY KEY (device_id, channel_id)) WITHOUT ROWID;')
+            cur.execute('INSERT INTO usage_watermarks (device_id, channel_id, last_timestamp) '
+                        'SELECT device_id, channel_id, max(timestamp) FROM usage_data GROUP BY device_id, channel_id;')
+        self._tables_checked = True
+
+
+_backend = None
+
+
+def get_backend():
+    """ Returns the storage backend chosen by the 'backend' key of the 'db' config: 'mysql' (the
+    default) or 'sqlite' (which uses the 'path' key as the database file). """
+
+    global _backend
+    if _backend is None:
+        if config['db'].get('backend', 'mysql') == 'sqlite':
+            _backend = SQLiteBackend(config['db']['path'])
+        else:
+            _backend = MySQLBackend()
+    return _backend
+
+
+def db_configured() -> bool:
+    """ Returns whether a database has been configured (rather than left as in the example config). """
+
+    if 'db' not in config:
+        return False
+    if config['db'].get('backend', 'mysql') == 'sqlite':
+        return 'path' in config['db']
+    return 'user' in config['db'] and config['db']['user'] != 'changeme'
+
+
+def _write_summary(rows: int, written: int, failed: int, start_time: float) -> dict:
+    """ Records a finished write in the metrics, and returns the summary of it returned by write_to_db(). """
+
+    elapsed = time.time() - start_time
+    metrics.observe('emporia_stage_seconds', elapsed, stage='db_write')
+    metrics.inc('emporia_rows_total', written, outcome='inserted')
+    metrics.inc('emporia_rows_total', rows - written - failed, outcome='ignored')
+    metrics.inc('emporia_rows_total', failed, outcome='failed')
+    return {'rows': rows,
+            'written': written,
+            'ignored': rows - written - failed,
+            'failed': failed,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed > 0 else 0}
+
+
+def _record_fetched(cur, backend, values: UsageBatch) -> None:
+    """ Advances fetch_progress for the devices the values were fetched for. """
+
+    if values.fetched_until:
+        cur.executemany(backend.fetched_statement, [[device_id, until] for device_id, until in values.fetched_until.items()])
+
+
+def write_to_db(values: Union[UsageBatch, Iterable[dict]], batch_size: int = None) -> dict:
+    """ Inserts the usage rows (a UsageBatch, or usage dicts) into usage_data. Rows are sent as
+    multi-row INSERT IGNORE statements of batch_size rows (the 'db_batch_size' config value, 1000
+    if not set). If a batch fails, that batch is retried one row at a time so that only the bad
+    rows are skipped and reported.
+
+    The per-channel watermarks, and how far each device has been fetched (see
+    UsageBatch.fetched_until), are advanced in the same transaction as the rows themselves.
+
+    Returns a summary of the write: the number of rows seen, written, ignored (already present)
+    and failed, along with the elapsed time and throughput.
+
+    If the 'resolution' config value is 'minutes', the usage goes to usage_minutes instead (see
+    write_minute_usage()). On MySQL, at least 'db_bulk_load_rows' rows (default 100000) are loaded
+    with bulk_load() instead, unless the server doesn't allow it, falling back to the INSERTs if that
+    fails. After a failure, large writes always use the INSERTs.
+    """
+
+    if config.get('resolution', 'fifteen_minutes') == 'minutes':
+        return write_minute_usage(values, batch_size)
+    if batch_size is None:
+        batch_size = config.get('db_batch_size', 1000)
+    values = to_batch(values)
+
+    backend = get_backend()
+    bulk_load_rows = config.get('db_bulk_load_rows', 100000)
+    if isinstance(backend, MySQLBackend) and bulk_load_rows and len(values) >= bulk_load_rows and backend.bulk_load_allowed is not False:
+        try:
+            if backend.allows_bulk_load():
+                return bulk_load(values)
+        except Exception as err:
+            # Whatever stopped it will most likely stop every later batch too
+            backend.bulk_load_allowed = False
+            print(f'Unable to bulk load {len(values)} rows, inserting them (and any later large writes) instead: {err}',
+                  file=sys.stderr)
+
+    start_time = time.time()
+    written, failed = 0, 0
+    # The newest timestamp stored for each (device_id, channel_id)
+    watermarks = {}
+
+    def advance_watermark(row: tuple) -> None:
+        key = (row[0], row[1])
+        if row[5] > watermarks.get(key, 0):
+            watermarks[key] = row[5]
+
+    with backend.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            backend.create_tables(cur)
+            rows = values.rows(usage_columns)
+            while batch := list(islice(rows, batch_size)):
+                try:
+                    # executemany() rewrites this into a single multi-row INSERT
+                    with metrics.timed('db_batch'):
+                        cur.executemany(backend.insert_statement, batch)
+                    written += cur.rowcount
+                    for row in batch:
+                        advance_watermark(row)
+                except Exception:
+                    # Fall back to a row at a time so only the bad rows are lost
+                    for row in batch:
+                        try:
+                            cur.execute(backend.insert_statement, row)
+                            written += cur.rowcount
+                            advance_watermark(row)
+                        except:
+                            print('Unable to write to db ',
+                                  dict(zip(usage_columns, row)))
+                            failed += 1
+            if watermarks:
+                cur.executemany(backend.watermark_statement, [[device_id, channel_id, timestamp]
+                                                      for (device_id, channel_id), timestamp in watermarks.items()])
+            _record_fetched(cur, backend, values)
+        conn.commit()
+
+    return _write_summary(len(values), written, failed, start_time)
+
+
+def bulk_load_dir() -> str:
+    """ Returns the directory the bulk load files are written to ('db_bulk_dir', by default the system
+    temporary directory). """
+
+    return config.get('db_bulk_dir') or tempfile.gettempdir()
+
+
+def _tsv_field(value) -> str:
+    """ Formats a value for LOAD DATA's default tab-separated format. None, NaN and infinity become NULL. """
+
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def bulk_load(values: UsageBatch) -> dict:
+    """ Inserts a large batch of usage rows into usage_data on MySQL much faster than INSERTs can. The
+    rows are streamed into a temporary TSV file, loaded into a staging table with LOAD DATA LOCAL
+    INFILE and then merged into usage_data with INSERT IGNORE ... SELECT, so rows which are already
+    stored are still ignored. The watermarks are advanced from the staging table, and fetch_progress
+    from the batch, in the same transaction.
+
+    The MySQL server must allow local infile (local_infile=ON). Returns the same summary as
+    write_to_db(); rows LOAD DATA can't convert are loaded with the nearest value it can (with a
+    warning on the server) rather than counted as failed.
+    """
+
+    start_time = time.time()
+    columns = ', '.join(usage_columns)
+    backend = get_backend()
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', prefix='usage_data_', suffix='.tsv',
+                                     dir=bulk_load_dir(), delete=False) as tsv_file:
+        tsv_path = tsv_file.name
+        # The circuit columns are only formatted once per circuit
+        prefixes = ['\t'.join(_tsv_field(circuit[column]) for column in usage_columns[:-2]) + '\t' for circuit in values.circuits]
+        for circuit_index, timestamp, usage in zip(values.circuit_indexes, values.timestamps, values.usages):
+            tsv_file.write(f'{prefixes[circuit_index]}{_tsv_field(usage)}\t{timestamp}\n')
+
+    try:
+        with backend.connection() as conn:
+            with closing(conn.cursor()) as cur:
+                backend.create_tables(cur)
+                cur.execute('DROP TEMPORARY TABLE IF EXISTS usage_data_staging;')
+                # No keys, so the load is a straight append; usage_data's primary key does the deduplicating
+                cur.execute(f'CREATE TEMPORARY TABLE usage_data_staging ({schema.column_definitions});')
+                with metrics.timed('db_bulk_load'):
+                    cur.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE usage_data_staging CHARACTER SET utf8mb4 ({columns});",
+                                [tsv_path])
+                with metrics.timed('db_bulk_merge'):
+                    cur.execute(f'INSERT IGNORE INTO usage_data ({columns}) SELECT {columns} FROM usage_data_staging;')
+                    written = cur.rowcount
+                    cur.execute('INSERT INTO usage_watermarks (device_id, channel_id, last_timestamp) '
+                                'SELECT device_id, channel_id, max(timestamp) FROM usage_data_staging GROUP BY device_id, channel_id '
+                                'ON DUPLICATE KEY UPDATE last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp));')
+                _record_fetched(cur, backend, values)
+                cur.execute('DROP TEMPORARY TABLE usage_data_staging;')
+            conn.commit()
+    finally:
+        os.unlink(tsv_path)
+
+    return _write_summary(len(values), written, 0, start_time)
+
+
+def pack_minutes(readings: array) -> bytes:
+    """ Packs an hour of per-minute readings (60 floats, NaN where there is no reading) into the
+    240-byte little-endian float32 form stored in usage_minutes.usages. """
+
+    if sys.byteorder == 'big':
+        readings = array('f', readings)
+        readings.byteswap()
+    return readings.tobytes()
+
+
+def unpack_minutes(packed: bytes) -> array:
+    """ The reverse of pack_minutes(). """
+
+    readings = array('f')
+    readings.frombytes(packed)
+    if sys.byteorder == 'big':
+        readings.byteswap()
+    return readings
+
+
+def write_minute_usage(values: Union[UsageBatch, Iterable[dict]], batch_size: int = None) -> dict:
+    """ Stores per-minute usage in usage_minutes. Rather than a row per reading, as in usage_data,
+    each row holds one device channel for one hour, with the hour's 60 readings packed into a single
+    column as float32 (see pack_minutes()). This keeps minute data to a fifteenth of the rows of
+    15-minute data stored in usage_data.
+
+    Readings for an hour which is already partly stored are merged into its row. As with
+    write_to_db(), a minute which is already stored keeps its value. Rows are written batch_size
+    (the 'db_batch_size' config value, 1000 if not set) at a time, and the watermarks and
+    fetch_progress are advanced in the same transaction.
+
+    Returns the same summary as write_to_db(), counting readings rather than rows.
+    """
+
+    if batch_size is None:
+        batch_size = config.get('db_batch_size', 1000)
+    values = to_batch(values)
+
+    start_time = time.time()
+    # The readings for each (circuit index, hour), NaN for the minutes without one
+    hours = {}
+    watermarks = {}
+    for circuit_index, timestamp, usage in zip(values.circuit_indexes, values.timestamps, values.usages):
+        hour = timestamp - timestamp % 3600
+        readings = hours.get((circuit_index, hour))
+        if readings is None:
+            readings = hours[(circuit_index, hour)] = array('f', [math.nan]) * 60
+        readings[(timestamp - hour) // 60] = usage
+        if timestamp > watermarks.get(circuit_index, 0):
+            watermarks[circuit_index] = timestamp
+
+    def present(readings: array) -> int:
+        return sum(1 for usage in readings if not math.isnan(usage))
+
+    written, failed = 0, 0
+    backend = get_backend()
+    with backend.connection() as conn:
         with closing(conn.cursor()) as cur:
-            for data in values:
+            backend.create_tables(cur)
+            keys = list(hours)
+            for position in range(0, len(keys), batch_size):
+                batch_keys = keys[position:position + batch_size]
+
+                # Fetch the stored rows these readings need merging into
+                device_ids = sorted({values.circuits[circuit_index]['device_id'] for circuit_index, hour in batch_keys})
+                cur.execute(f"SELECT device_id, channel_id, hour, usages FROM usage_minutes "
+                            f"WHERE device_id IN ({', '.join([backend.placeholder] * len(device_ids))}) "
+                            f"AND hour BETWEEN {backend.placeholder} AND {backend.placeholder};",
+                            device_ids + [min(hour for circuit_index, hour in batch_keys),
+                                          max(hour for circuit_index, hour in batch_keys)])
+                stored = {(device_id, channel_id, hour): unpack_minutes(usages)
+                          for device_id, channel_id, hour, usages in cur.fetchall()}
+
+                batch, batch_written = [], []
+                for circuit_index, hour in batch_keys:
+                    circuit = values.circuits[circuit_index]
+                    readings = hours[(circuit_index, hour)]
+                    existing = stored.get((circuit['device_id'], circuit['channel_id'], hour))
+                    if existing is not None:
+                        readings = array('f', (old if not math.isnan(old) else new for old, new in zip(existing, readings)))
+                        new_readings = present(readings) - present(existing)
+                        if not new_readings:
+                            continue
+                    else:
+                        new_readings = present(readings)
+                    batch.append([circuit['device_id'], circuit['channel_id'], circuit['channel_type'],
+                                  circuit['channel_direction'], hour, pack_minutes(readings)])
+                    batch_written.append(new_readings)
+
+                if not batch:
+                    continue
                 try:
-                    cur.execute(
-                        'INSERT IGNORE INTO usage_data (device_id, channel_id, channel_type, channel_direction, channel_usage, timestamp) VALUES (%s, %s, %s, %s, %s, %s);',
-                        [data['device_id'], data['channel_id'], data['channel_type'], data['channel_direction'], data['channel_usage'],
-                         data['timestamp']])
-                except:
-                    print('Unable to write to db ',
-                          data)
+                    with metrics.timed('db_batch'):
+                        cur.executemany(backend.minute_statement, batch)
+                    written += sum(batch_written)
+                except Exception:
+                    # Fall back to a row at a time so only the bad rows are lost
+                    for row, new_readings in zip(batch, batch_written):
+                        try:
+                            cur.execute(backend.minute_statement, row)
+                            written += new_readings
+                        except:
+                            print('Unable to write to db ', dict(zip(minute_columns[:-1], row)))
+                            failed += new_readings
+            if watermarks:
+                cur.executemany(backend.watermark_statement,
+                                [[values.circuits[circuit_index]['device_id'], values.circuits[circuit_index]['channel_id'], timestamp]
+                                 for circuit_index, timestamp in watermarks.items()])
+            _record_fetched(cur, backend, values)
         conn.commit()
 
+    return _write_summary(len(values), written, failed, start_time)
 
-def get_most_recent_timestamp() -> (int, int):
-    # Default to getting the last hour if we don't have a DB
-    if 'db' not in config or 'user' not in config['db'] or config['db']['user'] == 'changeme':
-        return int(time.time()) - 3600,int(time.time())
 
-    with closing(mysql.connector.connect(**config['db'])) as conn:
+def read_minute_usage(since: int, until: int, device_ids: List[str] = None) -> UsageBatch:
+    """ Reads the per-minute usage stored by write_minute_usage() from since up to (but not
+    including) until, optionally for only some devices. The packed hours are unpacked back into a
+    sample per minute; minutes with no reading are left out. """
+
+    backend = get_backend()
+    query = (f"SELECT {', '.join(minute_columns)} FROM usage_minutes "
+             f"WHERE hour >= {backend.placeholder} AND hour < {backend.placeholder}")
+    params = [since - since % 3600, until]
+    if device_ids is not None:
+        query += f" AND device_id IN ({', '.join([backend.placeholder] * len(device_ids))})"
+        params.extend(device_ids)
+
+    usage = UsageBatch()
+    with backend.connection() as conn:
         with closing(conn.cursor()) as cur:
-            cur.execute('SELECT max(timestamp) AS most_recent FROM usage_data;', [])
-            try:
-                # Overlap by 31 minutes to make sure no data is missed
-                since = cur.fetchone()[0] - 1860
-                one_week_ago = int(time.time()) - 86400
-                if since < one_week_ago:
-                    print("Warning! No data records detected for more than a day. Fetching the next needed day "
-                          "rather than the most recent day.")
-                    return since, since + 86400
-                else:
-                    return since, int(time.time())
-            except:
-                print('Detected first run, getting data for last week. If seen more than once, this code is buggy.')
-                return int(time.time()) - 604800, int(time.time())
+            backend.create_tables(cur)
+            cur.execute(query + ' ORDER BY device_id, channel_id, hour;', params)
+            for device_id, channel_id, channel_type, channel_direction, hour, usages in cur.fetchall():
+                circuit_index = usage.add_circuit({'device_id': device_id, 'channel_id': channel_id,
+                                                   'channel_type': channel_type, 'channel_direction': channel_direction})
+                for minute, reading in enumerate(unpack_minutes(usages)):
+                    timestamp = hour + minute * 60
+                    if not math.isnan(reading) and since <= timestamp < until:
+                        usage.append(circuit_index, timestamp, reading)
+        conn.commit()
+    return usage
+
+
+def correct_timestamps(correct: Callable[[int], int], until: int, batch_size: int = 1000) -> int:
+    """ Moves every usage_data row stored before until to the timestamp correct() gives for it, a
+    device at a time. A moved row which lands on one already stored is dropped as a duplicate. The
+    device's watermarks are then recomputed from what is left. Returns the number of rows moved.
+
+    This is for repairing readings stored with the wrong timestamps (see
+    vced_stats_rest.local_timestamp_to_utc()); any rollups of them have to be rebuilt afterwards.
+    """
+
+    backend = get_backend()
+    placeholder = backend.placeholder
+    moved = 0
+    with backend.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            backend.create_tables(cur)
+            cur.execute(f'SELECT DISTINCT device_id FROM usage_data WHERE timestamp < {placeholder};', [until])
+            device_ids = [row[0] for row in cur.fetchall()]
+        for device_id in device_ids:
+            with closing(conn.cursor()) as cur:
+                cur.execute(f"SELECT {', '.join(usage_columns)} FROM usage_data "
+                            f'WHERE device_id = {placeholder} AND timestamp < {placeholder};', [device_id, until])
+                rows = cur.fetchall()
+                # Every channel of a device shares the same timestamps
+                corrected = {timestamp: correct(timestamp) for timestamp in {row[5] for row in rows}}
+                cur.execute(f'DELETE FROM usage_data WHERE device_id = {placeholder} AND timestamp < {placeholder};',
+                            [device_id, until])
+                for position in range(0, len(rows), batch_size):
+                    cur.executemany(backend.insert_statement, [tuple(row[:5]) + (corrected[row[5]],)
+                                                               for row in rows[position:position + batch_size]])
+                cur.execute(f'DELETE FROM usage_watermarks WHERE device_id = {placeholder};', [device_id])
+                cur.execute('INSERT INTO usage_watermarks (device_id, channel_id, last_timestamp) '
+                            'SELECT device_id, channel_id, max(timestamp) FROM usage_data '
+                            f'WHERE device_id = {placeholder} GROUP BY device_id, channel_id;', [device_id])
+            conn.commit()
+            moved += sum(1 for row in rows if corrected[row[5]] != row[5])
+    return moved
+
+
+def _fetch_window(most_recent: int, fetched_until: int, now: int, max_window: int) -> (int, int):
+    """ Works out the period to fetch for a device given the newest timestamp stored for it, and how
+    far it has been fetched. """
+
+    # A device which is behind, or has never had any data, carries on from where the last fetch
+    # ended, even if nothing came back (it was offline, or the period is older than the API's history)
+    if fetched_until is not None and (most_recent is None or (max_window is not None and most_recent < now - max_window)):
+        most_recent = max(most_recent or 0, fetched_until)
+    if most_recent is None:
+        return now - 604800, now
+    # Overlap by 31 minutes to make sure no data is missed, rounded down to a 15-minute bucket
+    # so devices which are up to date end up sharing the same window
+    since = most_recent - 1860
+    since -= since % 900
+    if max_window is not None and since < now - max_window:
+        return since, since + max_window
+    return since, now
+
+
+# Without a DB, how far each device has been fetched by this process (see remember_fetched())
+_fetched_in_memory: Dict[str, int] = {}
+_fetched_in_memory_lock = threading.Lock()
+
+
+def remember_fetched(values: UsageBatch) -> None:
+    """ Records how far the devices in values have been fetched, for get_device_windows() to carry on
+    from when there is no DB to keep track (such as a daemon writing CSV or Parquet). """
+
+    with _fetched_in_memory_lock:
+        for device_id, until in values.fetched_until.items():
+            if until > _fetched_in_memory.get(device_id, 0):
+                _fetched_in_memory[device_id] = until
+
+
+def get_device_windows(device_ids: List[str], max_window: int = 86400) -> Dict[Tuple[int, int], List[str]]:
+    """ Returns the period of usage that needs to be fetched for each of the given devices,
+    based on the newest data stored for each of them. Devices which need the same period are
+    grouped together, so the result maps each (since, until) window to a list of device IDs.
+
+    A device with no data yet gets the last week. A device that is more than max_window seconds
+    behind gets the next max_window seconds it is missing, so it is caught up over the following
+    runs. Such a device moves on from the end of its last fetch even if that returned nothing, so a
+    gap in its data doesn't hold it back. With max_window=None every device is fetched up to now
+    (for backfills).
+
+    Without a DB, a device carries on from the start of the bucket which was still in progress when
+    this process last fetched it (see remember_fetched()), or else gets the last hour.
+    """
+
+    now = int(time.time())
+    if not db_configured():
+        bucket_seconds = 60 if config.get('resolution', 'fifteen_minutes') == 'minutes' else 900
+        windows = {}
+        with _fetched_in_memory_lock:
+            for device_id in device_ids:
+                fetched_until = _fetched_in_memory.get(device_id)
+                since = now - 3600 if fetched_until is None else fetched_until - fetched_until % bucket_seconds
+                if max_window is not None:
+                    since = max(since, now - max_window)
+                windows.setdefault((since, now), []).append(device_id)
+        return windows
+
+    backend = get_backend()
+    with backend.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            backend.create_tables(cur)
+            # Only reads the watermark table, so this doesn't get slower as usage_data grows
+            cur.execute('SELECT device_id, max(last_timestamp) FROM usage_watermarks GROUP BY device_id;')
+            most_recent = dict(cur.fetchall())
+            cur.execute('SELECT device_id, fetched_until FROM fetch_progress;')
+            fetched_until = dict(cur.fetchall())
+        conn.commit()
+
+    windows = {}
+    for device_id in device_ids:
+        window = _fetch_window(most_recent.get(device_id), fetched_until.get(device_id), now, max_window)
+        windows.setdefault(window, []).append(device_id)
+
+    behind = sum(len(ids) for (since, until), ids in windows.items() if until != now)
+    if behind:
+        print(f"Warning! {behind} device(s) have no data records for more than a day. Fetching the next needed day "
+              f"for those rather than the most recent day.")
+    new = sum(1 for device_id in device_ids if device_id not in most_recent and device_id not in fetched_until)
+    if new:
+        print(f'Detected {new} device(s) with no data, getting data for last week.')
+    return windows
+
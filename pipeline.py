@@ -0,0 +1,57 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def ordered_map(fn: Callable[[T], R], items: Iterable[T], concurrency: int) -> Iterator[R]:
+    """ Like ThreadPoolExecutor.map(), yields fn(item) for each item in order, with up to concurrency
+    calls running at once. Unlike map(), new calls are only started as results are consumed, so at
+    most concurrency results are ever held at once. """
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_pipeline(batches: Iterable[T], write: Callable[[T], None], queue_depth: int = 4) -> None:
+    """ Passes each batch from the batches iterable to write(), with the writing done on a separate
+    thread so the next batches are fetched while the previous ones are written. At most queue_depth
+    batches wait to be written; beyond that, fetching pauses until the writer catches up.
+
+    If write() raises, fetching stops and the exception is re-raised here.
+    """
+
+    waiting = queue.Queue(maxsize=queue_depth)
+    errors = []
+
+    def writer():
+        while (batch := waiting.get()) is not None:
+            # After a failure, keep draining the queue so the fetching side never blocks
+            if not errors:
+                try:
+                    write(batch)
+                except BaseException as err:
+                    errors.append(err)
+
+    writer_thread = threading.Thread(target=writer, name='usage-writer')
+    writer_thread.start()
+    try:
+        for batch in batches:
+            if errors:
+                break
+            waiting.put(batch)
+    finally:
+        waiting.put(None)
+        writer_thread.join()
+    if errors:
+        raise errors[0]
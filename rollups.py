@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import math
+import sys
+import time
+from contextlib import closing
+from typing import Dict, Iterator, List, Set, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import metrics
+import mysql_functions
+from settings import config
+from usage_batch import UsageBatch
+
+# Each rollup table holds the total usage and the number of readings summed for each device channel
+# in a bucket. usage_hourly buckets are the start of each hour in the device's timezone (as an epoch
+# timestamp), usage_daily buckets are local dates and usage_monthly buckets are 'YYYY-MM'.
+rollup_columns = ['device_id', 'channel_id', 'bucket', 'channel_usage', 'readings']
+
+# vced_stats.py stores each reading at the start of its interval, but vced_stats_rest.py stores it at
+# the end (as it always has). With interval_end set, readings are moved back by reading_seconds() so
+# each lands in the hour it was measured in.
+
+
+def reading_seconds() -> int:
+    """ Returns the length of the interval each stored reading covers. """
+
+    return 60 if config.get('resolution', 'fifteen_minutes') == 'minutes' else 900
+
+
+def create_tables(cur, backend) -> None:
+    """ Creates the rollup tables, and the table of device timezones, if they don't exist yet. """
+
+    if isinstance(backend, mysql_functions.SQLiteBackend):
+        text, real, date, suffix = 'TEXT', 'REAL', 'TEXT', ' WITHOUT ROWID'
+    else:
+        text, real, date, suffix = 'VARCHAR(64)', 'DOUBLE', 'DATE', ''
+    for table, bucket_type in [('usage_hourly', 'BIGINT'), ('usage_daily', date), ('usage_monthly', 'CHAR(7)')]:
+        cur.execute(f'CREATE TABLE IF NOT EXISTS {table} (device_id {text} NOT NULL, channel_id INT NOT NULL, '
+                    f'bucket {bucket_type} NOT NULL, channel_usage {real}, readings INT NOT NULL, '
+                    f'PRIMARY KEY (device_id, channel_id, bucket)){suffix};')
+    cur.execute(f'CREATE TABLE IF NOT EXISTS device_timezones (device_id {text} NOT NULL PRIMARY KEY, '
+                f'timezone {text} NOT NULL){suffix};')
+
+
+_zones = {}
+
+
+def get_zone(name: str) -> datetime.tzinfo:
+    """ Returns the timezone with the given IANA name. An unknown (or missing) timezone is treated
+    as UTC. """
+
+    zone = _zones.get(name)
+    if zone is None:
+        try:
+            zone = ZoneInfo(name or 'UTC')
+        except (ZoneInfoNotFoundError, ValueError):
+            print(f'Unknown timezone {name!r}, using UTC for its rollups.', file=sys.stderr)
+            zone = datetime.timezone.utc
+        _zones[name] = zone
+    return zone
+
+
+def local_hours(timestamps: Iterator[int], zone: datetime.tzinfo) -> Dict[int, int]:
+    """ Maps each of the timestamps to the start of the hour it falls in, in the given timezone. The
+    UTC offset is only looked up once per 15 minutes of timestamps, since offsets only change on
+    those boundaries. """
+
+    offsets, hours = {}, {}
+    for timestamp in timestamps:
+        if timestamp in hours:
+            continue
+        quarter = timestamp - timestamp % 900
+        offset = offsets.get(quarter)
+        if offset is None:
+            offset = offsets[quarter] = int(datetime.datetime.fromtimestamp(quarter, zone).utcoffset().total_seconds())
+        hours[timestamp] = timestamp - (timestamp + offset) % 3600
+    return hours
+
+
+def local_day_bounds(day: datetime.date, zone: datetime.tzinfo) -> Tuple[int, int]:
+    """ Returns the epoch timestamps at which a local date starts and ends. """
+
+    start = datetime.datetime.combine(day, datetime.time(), zone)
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(), zone)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def _read_timezones(cur) -> Dict[str, str]:
+    cur.execute('SELECT device_id, timezone FROM device_timezones;')
+    return dict(cur.fetchall())
+
+
+def _store_timezones(cur, backend, timezones: Dict[str, str]) -> None:
+    p = backend.placeholder
+    cur.executemany(f'DELETE FROM device_timezones WHERE device_id = {p};', [[device_id] for device_id in timezones])
+    cur.executemany(f'INSERT INTO device_timezones (device_id, timezone) VALUES ({p}, {p});',
+                    [[device_id, timezone] for device_id, timezone in timezones.items()])
+
+
+def _stored_samples(cur, backend, device_id: str, since: int, until: int) -> Iterator[Tuple[int, int, float]]:
+    """ Yields (channel_id, timestamp, usage) for everything stored for a device from since up to until,
+    from usage_minutes if the 'resolution' config value is 'minutes', otherwise from usage_data. """
+
+    p = backend.placeholder
+    if config.get('resolution', 'fifteen_minutes') == 'minutes':
+        cur.execute(f'SELECT channel_id, hour, usages FROM usage_minutes WHERE device_id = {p} AND hour >= {p} AND hour < {p};',
+                    [device_id, since - since % 3600, until])
+        for channel_id, hour, usages in cur.fetchall():
+            for minute, usage in enumerate(mysql_functions.unpack_minutes(usages)):
+                if not math.isnan(usage) and since <= hour + minute * 60 < until:
+                    yield channel_id, hour + minute * 60, usage
+    else:
+        cur.execute(f'SELECT channel_id, timestamp, channel_usage FROM usage_data '
+                    f'WHERE device_id = {p} AND timestamp >= {p} AND timestamp < {p};', [device_id, since, until])
+        yield from cur.fetchall()
+
+
+def _recompute(cur, backend, device_id: str, hours: Set[int], zone: datetime.tzinfo, interval_end: bool = False) -> None:
+    """ Recomputes the given local hours of a device from the stored usage, then the days and months
+    containing them from the hours and days. Buckets left without any usage are removed. """
+
+    p = backend.placeholder
+    offset = reading_seconds() if interval_end else 0
+
+    # Hours are summed from the usage itself
+    samples = [(channel_id, timestamp - offset, usage) for channel_id, timestamp, usage
+               in _stored_samples(cur, backend, device_id, min(hours) + offset, max(hours) + 3600 + offset)]
+    hour_of = local_hours((timestamp for channel_id, timestamp, usage in samples), zone)
+    sums = {}
+    for channel_id, timestamp, usage in samples:
+        hour = hour_of[timestamp]
+        if hour in hours:
+            total = sums.setdefault((channel_id, hour), [0.0, 0])
+            total[0] += usage
+            total[1] += 1
+    cur.executemany(f'DELETE FROM usage_hourly WHERE device_id = {p} AND bucket = {p};', [[device_id, hour] for hour in hours])
+    cur.executemany(f"INSERT INTO usage_hourly ({', '.join(rollup_columns)}) VALUES ({', '.join([p] * len(rollup_columns))});",
+                    [[device_id, channel_id, hour, usage, readings] for (channel_id, hour), (usage, readings) in sums.items()])
+
+    # Days are summed from the hours, and months from the days
+    days = {datetime.datetime.fromtimestamp(hour, zone).date() for hour in hours}
+    for day in sorted(days):
+        cur.execute(f'DELETE FROM usage_daily WHERE device_id = {p} AND bucket = {p};', [device_id, day.isoformat()])
+        cur.execute(f"INSERT INTO usage_daily ({', '.join(rollup_columns)}) "
+                    f"SELECT device_id, channel_id, {p}, sum(channel_usage), sum(readings) FROM usage_hourly "
+                    f"WHERE device_id = {p} AND bucket >= {p} AND bucket < {p} GROUP BY device_id, channel_id;",
+                    [day.isoformat(), device_id, *local_day_bounds(day, zone)])
+    for month in sorted({day.replace(day=1) for day in days}):
+        next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+        cur.execute(f'DELETE FROM usage_monthly WHERE device_id = {p} AND bucket = {p};', [device_id, month.isoformat()[:7]])
+        cur.execute(f"INSERT INTO usage_monthly ({', '.join(rollup_columns)}) "
+                    f"SELECT device_id, channel_id, {p}, sum(channel_usage), sum(readings) FROM usage_daily "
+                    f"WHERE device_id = {p} AND bucket >= {p} AND bucket < {p} GROUP BY device_id, channel_id;",
+                    [month.isoformat()[:7], device_id, month.isoformat(), next_month.isoformat()])
+
+
+def update_rollups(values: UsageBatch, timezones: Dict[str, str] = None, interval_end: bool = False) -> dict:
+    """ Brings the rollups up to date after values have been written with write_to_db(). Only the
+    hours the values fall in, and the days and months containing those hours, are recomputed. Each
+    is recomputed from everything stored for it, so values which were already stored (such as the
+    overlap fetched again on every run) are only counted once.
+
+    timezones maps device IDs to the name of their timezone, which days and months are worked out
+    in. They are stored, so a device without one here uses its stored timezone (or UTC).
+
+    interval_end is set when the timestamps are the end of each reading's interval (as
+    vced_stats_rest.py stores them) rather than the start.
+
+    Returns the number of device hours recomputed and how long it took.
+    """
+
+    start_time = time.time()
+    backend = mysql_functions.get_backend()
+    with backend.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            create_tables(cur, backend)
+            if timezones:
+                _store_timezones(cur, backend, timezones)
+            stored_timezones = _read_timezones(cur)
+
+            # The start of the interval of each reading written for each device
+            offset = reading_seconds() if interval_end else 0
+            device_timestamps = {}
+            for circuit_index, timestamp in zip(values.circuit_indexes, values.timestamps):
+                device_timestamps.setdefault(values.circuits[circuit_index]['device_id'], set()).add(timestamp - offset)
+
+            recomputed = 0
+            for device_id, timestamps in device_timestamps.items():
+                zone = get_zone(stored_timezones.get(device_id))
+                hours = set(local_hours(timestamps, zone).values())
+                _recompute(cur, backend, device_id, hours, zone, interval_end)
+                recomputed += len(hours)
+        conn.commit()
+
+    elapsed = time.time() - start_time
+    metrics.observe('emporia_stage_seconds', elapsed, stage='rollups')
+    return {'hours': recomputed, 'seconds': elapsed}
+
+
+def rebuild_rollups(since: int, until: int, device_ids: List[str] = None, interval_end: bool = False) -> dict:
+    """ Regenerates the rollups from scratch for every local hour which starts from since up to
+    until, and the days and months containing them. If device_ids isn't given, every device with
+    stored usage is rebuilt. Each device is committed separately. interval_end is as for
+    update_rollups(). """
+
+    start_time = time.time()
+    backend = mysql_functions.get_backend()
+    with backend.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            create_tables(cur, backend)
+            backend.create_tables(cur)
+            stored_timezones = _read_timezones(cur)
+            if device_ids is None:
+                cur.execute('SELECT DISTINCT device_id FROM usage_watermarks;')
+                device_ids = [device_id for (device_id,) in cur.fetchall()]
+
+            rebuilt = 0
+            for device_id in device_ids:
+                zone = get_zone(stored_timezones.get(device_id))
+                first_hour = local_hours([since], zone)[since]
+                if first_hour < since:
+                    first_hour += 3600
+                hours = set(range(first_hour, until, 3600))
+                if hours:
+                    _recompute(cur, backend, device_id, hours, zone, interval_end)
+                    conn.commit()
+                    rebuilt += len(hours)
+
+    return {'hours': rebuilt, 'seconds': time.time() - start_time}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Regenerates the hourly, daily and monthly usage rollups from the stored usage.')
+    parser.add_argument('--since', type=int, required=True, help='Rebuild from this epoch timestamp.')
+    parser.add_argument('--until', type=int, help='Rebuild up to this epoch timestamp (default now).')
+    parser.add_argument('--device', action='append', dest='device_ids', metavar='DEVICE_ID',
+                        help='Only rebuild this device. May be given more than once. (Default all devices.)')
+    parser.add_argument('--interval-end', action='store_true',
+                        help='The usage was stored by vced_stats_rest.py, which timestamps each reading with the end '
+                             'of its interval rather than the start.')
+    args = parser.parse_args()
+
+    if not mysql_functions.db_configured():
+        print('No database is configured.', file=sys.stderr)
+        sys.exit(1)
+    rebuild_stats = rebuild_rollups(args.since, args.until or int(time.time()), args.device_ids, args.interval_end)
+    print(f"Rebuilt {rebuild_stats['hours']} device hours in {rebuild_stats['seconds']:.1f}s")
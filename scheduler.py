@@ -0,0 +1,192 @@
+import datetime
+import email.utils
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+import metrics
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class RetryableError(Exception):
+    """ Raised by a request which may succeed if it's tried again later, such as an HTTP 429 or 5xx.
+    throttled marks rate limiting, and retry_after is how many seconds the server asked us to wait. """
+
+    def __init__(self, message: str, retry_after: float = None, throttled: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Parses a Retry-After header, which is either a number of seconds or an HTTP date. """
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class AdaptiveScheduler:
+    """ Runs requests with retries, and adjusts how many are in flight and how many items (devices) go
+    in each from how the server is coping, in the style of TCP's AIMD congestion control:
+
+    * Each request which succeeds faster than target_latency adds a little to the concurrency (about
+      one more request per round of requests) and adds chunk_step to the chunk size.
+    * A request slower than target_latency halves the chunk size.
+    * Rate limiting halves the concurrency, and holds back every request until the Retry-After has passed.
+    * Other retryable failures (5xx, dropped connections) halve both.
+
+    Only one decrease is applied per round of requests, since a burst of failures is usually a single
+    event. A failed request is retried up to max_attempts times in all, waiting a random time of up to
+    backoff * 2 ** retries seconds (capped at backoff_cap), or the Retry-After if that's longer.
+
+    The concurrency limits the requests in flight across every caller, so it holds however many
+    map_chunks() calls (such as backfill windows) run at once. A call() made from inside another
+    (such as fetching a new auth token for a request) runs in its caller's place.
+
+    The same scheduler is meant to be reused for a whole run (or for the life of a daemon), so what
+    it learns carries over from one call to the next.
+    """
+
+    def __init__(self, concurrency: int = 4, max_concurrency: int = 16, chunk_size: int = 100, min_chunk_size: int = 10,
+                 max_chunk_size: int = 100, chunk_step: int = 10, target_latency: float = 10, max_attempts: int = 5,
+                 backoff: float = 1, backoff_cap: float = 60, name: str = 'rest'):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.concurrency = float(min(max(concurrency, 1), self.max_concurrency))
+        self.max_chunk_size = max(max_chunk_size, 1)
+        self.min_chunk_size = min(max(min_chunk_size, 1), self.max_chunk_size)
+        self.chunk_size = float(min(max(chunk_size, self.min_chunk_size), self.max_chunk_size))
+        self.chunk_step = chunk_step
+        self.target_latency = target_latency
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.name = name
+        self._lock = threading.Lock()
+        # Signalled whenever a request finishes, or the concurrency goes up
+        self._slots = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._local = threading.local()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._record_limits()
+
+    def _record_limits(self) -> None:
+        metrics.set_gauge('emporia_scheduler_concurrency', int(self.concurrency), scheduler=self.name)
+        metrics.set_gauge('emporia_scheduler_chunk_size', int(self.chunk_size), scheduler=self.name)
+
+    def _succeeded(self, latency: float) -> None:
+        with self._lock:
+            if latency > self.target_latency:
+                self._decrease(time.time() - latency, chunk_size=True)
+            else:
+                self.concurrency = min(self.concurrency + 1 / self.concurrency, self.max_concurrency)
+                self.chunk_size = min(self.chunk_size + self.chunk_step, self.max_chunk_size)
+                self._slots.notify_all()
+            self._record_limits()
+
+    def _failed(self, err: RetryableError, started: float) -> None:
+        with self._lock:
+            if err.retry_after:
+                self._paused_until = max(self._paused_until, time.time() + err.retry_after)
+            self._decrease(started, concurrency=True, chunk_size=not err.throttled)
+            self._record_limits()
+
+    def _decrease(self, started: float, concurrency: bool = False, chunk_size: bool = False) -> None:
+        # A request which was sent before the last decrease doesn't reflect the current limits
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.time()
+        if concurrency:
+            self.concurrency = max(self.concurrency / 2, 1)
+        if chunk_size:
+            self.chunk_size = max(self.chunk_size / 2, self.min_chunk_size)
+
+    @contextmanager
+    def _slot(self):
+        """ Waits until fewer than the current concurrency of requests are in flight, and holds a place
+        among them until the block ends. """
+
+        if getattr(self._local, 'holding', False):
+            yield
+            return
+        with self._slots:
+            while self._in_flight >= int(self.concurrency):
+                self._slots.wait()
+            self._in_flight += 1
+        self._local.holding = True
+        try:
+            yield
+        finally:
+            self._local.holding = False
+            with self._slots:
+                self._in_flight -= 1
+                self._slots.notify_all()
+
+    def call(self, fn: Callable[..., R], *args) -> R:
+        """ Returns fn(*args), retrying it with backoff while it raises RetryableError. Once max_attempts
+        have failed, the last error is raised. """
+
+        for attempt in range(self.max_attempts):
+            with self._lock:
+                pause = self._paused_until - time.time()
+            if pause > 0:
+                time.sleep(pause)
+
+            try:
+                with self._slot():
+                    started = time.time()
+                    result = fn(*args)
+            except RetryableError as err:
+                self._failed(err, started)
+                if attempt + 1 == self.max_attempts:
+                    raise
+                delay = max(random.uniform(0, min(self.backoff * 2 ** attempt, self.backoff_cap)), err.retry_after or 0)
+                metrics.inc('emporia_request_retries_total', scheduler=self.name, reason='throttled' if err.throttled else 'error')
+                print(f'{err}; retrying in {delay:.1f}s (attempt {attempt + 2} of {self.max_attempts})', file=sys.stderr)
+                time.sleep(delay)
+                continue
+            self._succeeded(time.time() - started)
+            return result
+
+    def map_chunks(self, fn: Callable[[List[T]], R], items: Sequence[T]) -> Iterator[Tuple[List[T], R]]:
+        """ Splits items into chunks of the current chunk size and yields (chunk, fn(chunk)) for each,
+        in order, with up to the current concurrency of chunks in flight. Each chunk is retried on its
+        own (see call()); if a chunk still fails, (chunk, error) is yielded in its place, so the
+        chunks already fetched aren't lost. Like pipeline.ordered_map(), new chunks are only started
+        as results are consumed. """
+
+        def run(chunk: List[T]):
+            try:
+                return self.call(fn, chunk)
+            except Exception as err:
+                return err
+
+        position = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = deque()
+            while position < len(items) or pending:
+                # The limits are read afresh for each chunk, so they take effect straight away
+                while position < len(items) and len(pending) < int(self.concurrency):
+                    chunk = list(items[position:position + int(self.chunk_size)])
+                    position += len(chunk)
+                    pending.append((chunk, executor.submit(run, chunk)))
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import sys
+import time
+from contextlib import closing
+from typing import List, Tuple
+
+from settings import config
+
+# The usage_data columns as the fetchers write them. The primary key both identifies a reading and
+# makes INSERT IGNORE skip the ones already stored.
+column_definitions = ('device_id VARCHAR(64) NOT NULL, channel_id INT NOT NULL, channel_type VARCHAR(64), '
+                      'channel_direction INT, channel_usage DOUBLE, timestamp BIGINT NOT NULL')
+primary_key = ['device_id', 'channel_id', 'timestamp']
+copied_columns = 'device_id, channel_id, channel_type, channel_direction, channel_usage, timestamp'
+
+# usage_data is partitioned by RANGE on the timestamp, a partition per month (UTC) named pYYYYMM,
+# which holds the readings before the start of the following month. The first partition also holds
+# everything older, and pmax catches anything beyond the last month created.
+
+
+def month_start(timestamp: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0)
+
+
+def add_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return month.replace(year=year, month=month_index + 1)
+
+
+def months_between(first_month: datetime.datetime, last_month: datetime.datetime) -> List[datetime.datetime]:
+    months = []
+    month = first_month
+    while month <= last_month:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def partition_definitions(months: List[datetime.datetime]) -> List[str]:
+    return [f'PARTITION p{month:%Y%m} VALUES LESS THAN ({int(add_months(month, 1).timestamp())})' for month in months]
+
+
+def describe(cur) -> dict:
+    """ Returns the state of usage_data: whether it exists, its primary key columns, whether it has an
+    index starting with timestamp, how it's partitioned, and its partitions as (name, upper bound)
+    pairs, where the bound of the MAXVALUE partition is None. """
+
+    cur.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'usage_data';")
+    if not cur.fetchall()[0][0]:
+        return {'exists': False}
+
+    cur.execute("SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'usage_data' ORDER BY INDEX_NAME, SEQ_IN_INDEX;")
+    indexes = {}
+    for index_name, column_name in cur.fetchall():
+        indexes.setdefault(index_name, []).append(column_name)
+
+    cur.execute("SELECT PARTITION_NAME, PARTITION_METHOD, PARTITION_EXPRESSION, PARTITION_DESCRIPTION "
+                "FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'usage_data' "
+                "AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION;")
+    partition_rows = cur.fetchall()
+    partitioning = None
+    if partition_rows:
+        partitioning = f"{partition_rows[0][1]} ({partition_rows[0][2].replace('`', '')})"
+    return {'exists': True,
+            'primary_key': indexes.get('PRIMARY', []),
+            'timestamp_index': any(columns[0] == 'timestamp' for name, columns in indexes.items() if name != 'PRIMARY'),
+            'partitioning': partitioning,
+            'partitions': [(name, None if bound == 'MAXVALUE' else int(bound)) for name, method, expression, bound in partition_rows]}
+
+
+def _create_statement(table: str, first_month: datetime.datetime, last_month: datetime.datetime) -> str:
+    partitions = ', '.join(partition_definitions(months_between(first_month, last_month)) +
+                           ['PARTITION pmax VALUES LESS THAN MAXVALUE'])
+    return (f"CREATE TABLE {table} ({column_definitions}, PRIMARY KEY ({', '.join(primary_key)}), "
+            f"KEY {table}_timestamp (timestamp)) PARTITION BY RANGE (timestamp) ({partitions});")
+
+
+def create_usage_data(cur, since: int = None) -> bool:
+    """ Creates usage_data, partitioned from the month of since (by default last month) up to
+    'db_future_partitions' months ahead (default 3), if it doesn't exist yet. Returns whether it
+    was created. """
+
+    if describe(cur)['exists']:
+        return False
+    now = month_start(time.time())
+    first_month = month_start(since) if since is not None else add_months(now, -1)
+    cur.execute(_create_statement('usage_data', min(first_month, now), add_months(now, config.get('db_future_partitions', 3))))
+    return True
+
+
+def maintain_partitions(cur) -> Tuple[List[str], List[str]]:
+    """ Keeps a partitioned usage_data's partitions up to date: adds any missing months up to
+    'db_future_partitions' months ahead (default 3), and if 'db_retention_months' is set, drops the
+    partitions which only hold readings from before that many months ago (counting the current
+    month). Does nothing if usage_data isn't partitioned by month. Returns the names of the
+    partitions added and dropped. """
+
+    state = describe(cur)
+    if not state['exists'] or state['partitioning'] != 'RANGE (timestamp)':
+        return [], []
+    partitions = state['partitions']
+    bounds = [bound for name, bound in partitions if bound is not None]
+    has_max = any(bound is None for name, bound in partitions)
+    now = month_start(time.time())
+
+    # The months after the last existing one, up to the future partitions wanted
+    first_month = add_months(month_start(max(bounds) - 1), 1) if bounds else now
+    months = months_between(first_month, add_months(now, config.get('db_future_partitions', 3)))
+    added = [f'p{month:%Y%m}' for month in months]
+    if months:
+        definitions = partition_definitions(months)
+        if has_max:
+            cur.execute(f"ALTER TABLE usage_data REORGANIZE PARTITION pmax INTO "
+                        f"({', '.join(definitions + ['PARTITION pmax VALUES LESS THAN MAXVALUE'])});")
+        else:
+            cur.execute(f"ALTER TABLE usage_data ADD PARTITION ({', '.join(definitions)});")
+
+    dropped = []
+    retention_months = config.get('db_retention_months')
+    if retention_months:
+        cutoff = add_months(now, 1 - retention_months).timestamp()
+        dropped = [name for name, bound in partitions if bound is not None and bound <= cutoff]
+        if dropped:
+            cur.execute(f"ALTER TABLE usage_data DROP PARTITION {', '.join(dropped)};")
+    return added, dropped
+
+
+def upgrade_usage_data(cur) -> List[str]:
+    """ Brings an existing usage_data up to the current schema, returning a description of each change.
+
+    If its primary key isn't (device_id, channel_id, timestamp), the table is rebuilt: a new one is
+    created, the rows are copied in with INSERT IGNORE (dropping any duplicates) and the tables are
+    swapped, leaving the old one as usage_data_before_upgrade. Otherwise the timestamp index and the
+    monthly partitioning are added in place if they're missing. Either way this rewrites the whole
+    table, so can take a long time on a large one.
+    """
+
+    state = describe(cur)
+    if not state['exists']:
+        create_usage_data(cur)
+        return ['Created usage_data']
+
+    changes = []
+    now = month_start(time.time())
+    last_month = add_months(now, config.get('db_future_partitions', 3))
+    if state['primary_key'] != primary_key:
+        cur.execute('SELECT min(timestamp) FROM usage_data;')
+        oldest = cur.fetchall()[0][0]
+        first_month = min(month_start(oldest), now) if oldest is not None else now
+        cur.execute('DROP TABLE IF EXISTS usage_data_upgrade;')
+        cur.execute(_create_statement('usage_data_upgrade', first_month, last_month))
+        cur.execute(f'INSERT IGNORE INTO usage_data_upgrade ({copied_columns}) SELECT {copied_columns} FROM usage_data;')
+        copied = cur.rowcount
+        cur.execute('RENAME TABLE usage_data TO usage_data_before_upgrade, usage_data_upgrade TO usage_data;')
+        return [f"Rebuilt usage_data with the primary key ({', '.join(primary_key)}), the timestamp index and monthly "
+                f"partitions, copying {copied} rows. The old table is now usage_data_before_upgrade; drop it once "
+                f"you're happy with the new one."]
+
+    if not state['timestamp_index']:
+        cur.execute('ALTER TABLE usage_data ADD INDEX usage_data_timestamp (timestamp);')
+        changes.append('Added the timestamp index')
+    if state['partitioning'] is None:
+        cur.execute('SELECT min(timestamp) FROM usage_data;')
+        oldest = cur.fetchall()[0][0]
+        first_month = min(month_start(oldest), now) if oldest is not None else now
+        months = months_between(first_month, last_month)
+        cur.execute(f"ALTER TABLE usage_data PARTITION BY RANGE (timestamp) "
+                    f"({', '.join(partition_definitions(months) + ['PARTITION pmax VALUES LESS THAN MAXVALUE'])});")
+        changes.append(f'Partitioned usage_data by month into {len(months) + 1} partitions')
+    elif state['partitioning'] != 'RANGE (timestamp)':
+        changes.append(f"Left the existing {state['partitioning']} partitioning alone")
+    return changes
+
+
+if __name__ == "__main__":
+    import mysql_functions
+
+    parser = argparse.ArgumentParser(description='Shows the state of the usage_data table on MySQL, and creates or upgrades it '
+                                                 'to the current schema: a primary key of (device_id, channel_id, timestamp), '
+                                                 'an index on timestamp and monthly partitions.')
+    parser.add_argument('--upgrade', action='store_true',
+                        help='Upgrade usage_data. This rewrites the table, so can take a long time on a large one.')
+    parser.add_argument('--maintain', action='store_true',
+                        help='Add future partitions, and drop the ones past db_retention_months. (This is also done by '
+                             'the fetchers.)')
+    args = parser.parse_args()
+
+    if not mysql_functions.db_configured() or not isinstance(mysql_functions.get_backend(), mysql_functions.MySQLBackend):
+        print('No MySQL database is configured. (SQLite databases are set up automatically.)', file=sys.stderr)
+        sys.exit(1)
+
+    with mysql_functions.get_backend().connection() as conn:
+        with closing(conn.cursor()) as cur:
+            if args.upgrade:
+                for change in upgrade_usage_data(cur) or ['usage_data is already up to date']:
+                    print(change)
+            if args.upgrade or args.maintain:
+                added, dropped = maintain_partitions(cur)
+                print(f"Added partitions: {', '.join(added) or 'none'}. Dropped partitions: {', '.join(dropped) or 'none'}.")
+
+            state = describe(cur)
+            if not state['exists']:
+                print('usage_data does not exist yet. Run with --upgrade to create it.')
+            else:
+                print(f"Primary key: ({', '.join(state['primary_key'])})")
+                print(f"Index on timestamp: {'yes' if state['timestamp_index'] else 'no'}")
+                print(f"Partitioning: {state['partitioning'] or 'none'}")
+                for name, bound in state['partitions']:
+                    print(f"  {name}: {'MAXVALUE' if bound is None else f'before {bound}'}")
+        conn.commit()
@@ -0,0 +1,53 @@
+import json
+import os
+import pathlib
+import threading
+from collections.abc import MutableMapping
+
+config_path = os.path.normpath(os.path.join(pathlib.Path(__file__).parent.resolve(), 'config.json'))
+
+
+class Config(MutableMapping):
+    """ The contents of config.json, which is only read the first time a value is looked up (or set).
+    Importing a module which uses the config therefore doesn't touch the filesystem. """
+
+    def __init__(self, path: str = config_path):
+        self.path = path
+        self._values = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    with open(self.path, 'r') as config_file:
+                        self._values = json.load(config_file)
+        return self._values
+
+    def loaded(self) -> bool:
+        return self._values is not None
+
+    def use(self, values: dict) -> None:
+        """ Uses these values in place of config.json, which then isn't read at all. """
+
+        with self._lock:
+            self._values = dict(values)
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+# Shared by every module, so config.json is read at most once per process
+config = Config()
@@ -0,0 +1,179 @@
+import csv
+import gzip
+import io
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+from usage_batch import UsageBatch
+
+# The column order of the CSV output
+csv_columns = ['device_id', 'channel_id', 'channel_direction', 'channel_type', 'channel_usage', 'timestamp']
+
+
+class CsvSink:
+    """ Writes usage as CSV to stdout (path of None or '-') or to a file, a batch at a time, so the
+    output never needs to be held in memory. The output is gzip compressed if compress is set or
+    the path ends in '.gz'. If header is set, a header row is written first. The output is flushed
+    every flush_rows rows so a reader at the other end of a pipe sees the rows as they are fetched.
+    If that reader goes away (as with `| head`), the process exits quietly.
+    """
+
+    def __init__(self, path: str = None, compress: bool = False, header: bool = False, flush_rows: int = 10000):
+        self.flush_rows = flush_rows
+        self._unflushed = 0
+        compress = compress or (path is not None and path.endswith('.gz'))
+
+        self._to_stdout = path is None or path == '-'
+        if self._to_stdout:
+            if compress:
+                self._file = io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb'), newline='')
+            else:
+                self._file = sys.stdout
+            self._close_file = compress
+        else:
+            self._file = gzip.open(path, 'wt', newline='') if compress else open(path, 'w', newline='')
+            self._close_file = True
+
+        self._writer = csv.writer(self._file)
+        if header:
+            with self._stop_on_broken_pipe():
+                self._writer.writerow(csv_columns)
+
+    @contextmanager
+    def _stop_on_broken_pipe(self):
+        try:
+            yield
+        except BrokenPipeError:
+            if not self._to_stdout:
+                raise
+            # Nothing is reading stdout any more. Point it at devnull so flushing it when closing, and
+            # again at exit, doesn't fail too, and stop.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            sys.exit(1)
+
+    def write(self, usage: UsageBatch) -> None:
+        with self._stop_on_broken_pipe():
+            for row in usage.rows(csv_columns):
+                self._writer.writerow(row)
+                self._unflushed += 1
+                if self._unflushed >= self.flush_rows:
+                    self._file.flush()
+                    self._unflushed = 0
+
+    def close(self) -> None:
+        with self._stop_on_broken_pipe():
+            if self._close_file:
+                self._file.close()
+            else:
+                self._file.flush()
+
+    def __enter__(self) -> 'CsvSink':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ParquetSink:
+    """ Writes usage to a directory of Parquet files, partitioned by UTC date (date=YYYY-MM-DD/) and
+    optionally by device as well (date=.../device_id=.../). Each batch is appended as new files, so
+    existing data is never rewritten by a write. When the sink is closed, any partition written to
+    which has built up more than compact_files files is compacted into a single file, with rows
+    fetched more than once (the overlap between runs) de-duplicated.
+
+    Requires pyarrow, which is only imported when a ParquetSink is created.
+    """
+
+    def __init__(self, path: str, partition_by_device: bool = False, compact_files: int = 8):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('Writing Parquet requires pyarrow. Install it with "pip3 install pyarrow".') from None
+
+        self.path = path
+        self.partition_by_device = partition_by_device
+        self.compact_files = compact_files
+        self._touched = set()
+        self._partition_fields = [pyarrow.field('date', pyarrow.date32())]
+        if partition_by_device:
+            self._partition_fields.append(pyarrow.field('device_id', pyarrow.string()))
+
+    def _to_table(self, usage: UsageBatch):
+        import pyarrow
+        import pyarrow.compute
+
+        def from_array(values, arrow_type):
+            # Share the array's memory rather than converting it a value at a time
+            return pyarrow.Array.from_buffers(arrow_type, len(values), [None, pyarrow.py_buffer(values)])
+
+        circuit_indexes = from_array(usage.circuit_indexes, pyarrow.int64() if usage.circuit_indexes.itemsize == 8 else pyarrow.int32())
+        timestamps = from_array(usage.timestamps, pyarrow.int64())
+
+        def circuit_column(column, arrow_type, encode=False):
+            values = pyarrow.array([circuit[column] for circuit in usage.circuits], arrow_type)
+            if encode:
+                values = values.dictionary_encode()
+            return values.take(circuit_indexes)
+
+        return pyarrow.table({
+            'date': pyarrow.compute.cast(pyarrow.compute.cast(pyarrow.compute.divide(timestamps, 86400), pyarrow.int32()),
+                                         pyarrow.date32()),
+            'device_id': circuit_column('device_id', pyarrow.string(), encode=not self.partition_by_device),
+            'channel_id': circuit_column('channel_id', pyarrow.int16()),
+            'channel_direction': circuit_column('channel_direction', pyarrow.int8()),
+            'channel_type': circuit_column('channel_type', pyarrow.string(), encode=True),
+            'channel_usage': from_array(usage.usages, pyarrow.float64()),
+            'timestamp': timestamps,
+        })
+
+    def write(self, usage: UsageBatch) -> None:
+        import pyarrow
+        import pyarrow.dataset
+
+        if not len(usage):
+            return
+        pyarrow.dataset.write_dataset(
+            self._to_table(usage), self.path, format='parquet',
+            partitioning=pyarrow.dataset.partitioning(pyarrow.schema(self._partition_fields), flavor='hive'),
+            # Named so that sorting the names puts the files in the order they were written
+            basename_template=f'part-{time.time_ns():020d}-{uuid.uuid4().hex}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            file_visitor=lambda written_file: self._touched.add(os.path.dirname(written_file.path)))
+
+    def compact(self, partition_path: str) -> None:
+        """ Rewrites the files in a partition directory as a single file, dropping duplicate rows
+        (keeping the most recently written copy). """
+
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+
+        # In the order they were written (any earlier compacted file first), so the latest copy of a row wins
+        files = sorted(os.path.join(partition_path, name) for name in os.listdir(partition_path) if name.endswith('.parquet'))
+        table = pyarrow.concat_tables([pyarrow.parquet.read_table(file, partitioning=None) for file in files],
+                                      promote_options='permissive')
+        keys = [column for column in ['device_id', 'channel_id', 'timestamp'] if column in table.column_names]
+        table = table.append_column('_row', pyarrow.array(range(len(table)), pyarrow.int64()))
+        latest = table.group_by(keys, use_threads=False).aggregate([('_row', 'max')])['_row_max']
+        table = table.take(latest.take(pyarrow.compute.sort_indices(latest))).drop_columns(['_row'])
+
+        compacted_path = os.path.join(partition_path, f'compacted-{uuid.uuid4().hex}.parquet')
+        pyarrow.parquet.write_table(table, compacted_path)
+        for file in files:
+            os.remove(file)
+
+    def close(self) -> None:
+        for partition_path in self._touched:
+            if sum(1 for name in os.listdir(partition_path) if name.endswith('.parquet')) > self.compact_files:
+                self.compact(partition_path)
+        self._touched.clear()
+
+    def __enter__(self) -> 'ParquetSink':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
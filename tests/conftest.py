@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql_functions  # noqa: E402
+import settings  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def config():
+    """ Runs each test with an empty config of its own, so config.json is never read. """
+
+    settings.config.use({})
+    yield settings.config
+    mysql_functions._backend = None
+
+
+@pytest.fixture
+def sqlite_db(config, tmp_path):
+    """ Stores to a fresh SQLite database. """
+
+    config['db'] = {'backend': 'sqlite', 'path': str(tmp_path / 'usage.sqlite3')}
+    mysql_functions._backend = None
+    return mysql_functions.get_backend()
@@ -0,0 +1,18 @@
+from backfill import split_window
+
+
+def test_split_window_aligns_to_window_boundaries():
+    assert split_window(0, 3 * 86400, 86400) == [(0, 86400), (86400, 172800), (172800, 259200)]
+
+
+def test_split_window_shortens_unaligned_ends():
+    assert split_window(3600, 86400 + 7200, 86400) == [(3600, 86400), (86400, 86400 + 7200)]
+
+
+def test_split_window_within_one_window():
+    assert split_window(100, 200, 86400) == [(100, 200)]
+
+
+def test_split_window_empty_period():
+    assert split_window(500, 500, 86400) == []
+    assert split_window(600, 500, 86400) == []
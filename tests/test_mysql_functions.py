@@ -0,0 +1,59 @@
+import math
+import struct
+from array import array
+
+from mysql_functions import _fetch_window, pack_minutes, unpack_minutes
+
+now = 1750000000 - 1750000000 % 900
+
+
+def test_fetch_window_without_any_data_fetches_the_last_week():
+    assert _fetch_window(None, None, now, 86400) == (now - 604800, now)
+
+
+def test_fetch_window_overlaps_and_aligns_to_a_bucket():
+    since, until = _fetch_window(now - 900, None, now, 86400)
+    assert until == now
+    assert since % 900 == 0
+    assert now - 900 - 1860 - 900 < since <= now - 900 - 1860
+
+
+def test_fetch_window_caps_a_device_which_is_behind():
+    most_recent = now - 10 * 86400
+    since, until = _fetch_window(most_recent, None, now, 86400)
+    assert until - since == 86400
+    assert since <= most_recent - 1860
+
+
+def test_fetch_window_without_a_cap_catches_up_to_now():
+    since, until = _fetch_window(now - 10 * 86400, None, now, None)
+    assert until == now
+
+
+def test_fetch_window_continues_from_where_the_last_fetch_ended():
+    # Nothing came back for the device (it was offline), but the period has been fetched
+    fetched_until = now - 5 * 86400
+    expected = _fetch_window(fetched_until, None, now, 86400)
+    assert expected[0] < fetched_until
+    assert _fetch_window(None, fetched_until, now, 86400) == expected
+    assert _fetch_window(now - 10 * 86400, fetched_until, now, 86400) == expected
+
+
+def test_fetch_window_ignores_fetched_until_for_a_device_which_is_up_to_date():
+    assert _fetch_window(now - 900, now - 3 * 86400, now, 86400) == _fetch_window(now - 900, None, now, 86400)
+
+
+def test_pack_minutes_round_trips():
+    readings = array('f', [minute * 0.5 for minute in range(60)])
+    readings[7] = math.nan
+    packed = pack_minutes(readings)
+    assert len(packed) == 240
+    unpacked = unpack_minutes(packed)
+    assert math.isnan(unpacked[7])
+    assert [value for minute, value in enumerate(unpacked) if minute != 7] == \
+           [value for minute, value in enumerate(readings) if minute != 7]
+
+
+def test_pack_minutes_is_little_endian_float32():
+    packed = pack_minutes(array('f', [1.5] + [math.nan] * 59))
+    assert packed[:4] == struct.pack('<f', 1.5)
@@ -0,0 +1,129 @@
+import calendar
+import datetime
+from contextlib import closing
+
+import mysql_functions
+import rollups
+from rollups import get_zone, local_day_bounds, local_hours
+from usage_batch import UsageBatch
+
+
+def utc(*fields) -> int:
+    return calendar.timegm(datetime.datetime(*fields).timetuple())
+
+
+def write_usage(timestamps, device_id='device', timezone='UTC', interval_end=False):
+    """ Stores a reading of 1 for each timestamp and brings the rollups up to date. """
+
+    batch = UsageBatch()
+    circuit_index = batch.add_circuit({'device_id': device_id, 'channel_id': 1, 'channel_type': 'Main',
+                                       'channel_direction': 1})
+    for timestamp in timestamps:
+        batch.append(circuit_index, timestamp, 1.0)
+    mysql_functions.write_to_db(batch)
+    rollups.update_rollups(batch, {device_id: timezone}, interval_end)
+
+
+def buckets(table: str) -> dict:
+    with mysql_functions.get_backend().connection() as conn:
+        with closing(conn.cursor()) as cur:
+            cur.execute(f'SELECT bucket, channel_usage, readings FROM {table} ORDER BY bucket;')
+            return {bucket: (usage, readings) for bucket, usage, readings in cur.fetchall()}
+
+
+def test_local_hours_with_a_half_hour_offset():
+    zone = get_zone('Asia/Kolkata')
+    # 00:15 UTC is 05:45 in India, in the hour which started at 05:00 (23:30 UTC)
+    assert local_hours([utc(2025, 1, 1, 0, 15)], zone) == {utc(2025, 1, 1, 0, 15): utc(2024, 12, 31, 23, 30)}
+    assert local_hours([utc(2025, 1, 1, 0, 30)], zone) == {utc(2025, 1, 1, 0, 30): utc(2025, 1, 1, 0, 30)}
+
+
+def test_local_hours_keeps_the_repeated_hour_apart():
+    # 01:00-02:00 happens twice in New York when the clocks go back on 2 November 2025
+    zone = get_zone('America/New_York')
+    hours = local_hours([utc(2025, 11, 2, 5, 30), utc(2025, 11, 2, 6, 30)], zone)
+    assert sorted(hours.values()) == [utc(2025, 11, 2, 5), utc(2025, 11, 2, 6)]
+
+
+def test_local_day_bounds_across_daylight_saving_changes():
+    zone = get_zone('America/New_York')
+    start, end = local_day_bounds(datetime.date(2025, 3, 9), zone)
+    assert (start, end - start) == (utc(2025, 3, 9, 5), 23 * 3600)
+    start, end = local_day_bounds(datetime.date(2025, 11, 2), zone)
+    assert (start, end - start) == (utc(2025, 11, 2, 4), 25 * 3600)
+
+
+def test_unknown_timezone_is_utc():
+    assert get_zone('Not/AZone') is datetime.timezone.utc
+    assert get_zone(None).utcoffset(None) == datetime.timedelta(0)
+
+
+def test_short_day_rolls_up_its_23_hours(sqlite_db):
+    start, end = local_day_bounds(datetime.date(2025, 3, 9), get_zone('America/New_York'))
+    write_usage(range(start - 3600, end + 3600, 900), timezone='America/New_York')
+
+    assert len([hour for hour in buckets('usage_hourly') if start <= hour < end]) == 23
+    assert buckets('usage_daily')['2025-03-09'] == (92.0, 92)
+    assert buckets('usage_monthly')['2025-03'] == (100.0, 100)
+
+
+def test_day_boundary_with_a_half_hour_offset(sqlite_db):
+    # 1 January starts at 18:30 UTC on 31 December in India
+    write_usage([utc(2024, 12, 31, 18, 15), utc(2024, 12, 31, 18, 30)], timezone='Asia/Kolkata')
+
+    assert buckets('usage_daily') == {'2024-12-31': (1.0, 1), '2025-01-01': (1.0, 1)}
+    assert buckets('usage_monthly') == {'2024-12': (1.0, 1), '2025-01': (1.0, 1)}
+
+
+def test_interval_end_readings_roll_up_into_the_hour_they_were_measured_in(sqlite_db):
+    # Stored at the end of its interval, midnight local time, so measured on 31 December
+    midnight = utc(2024, 12, 31, 23)
+    write_usage([midnight], timezone='Europe/Berlin', interval_end=True)
+
+    assert buckets('usage_hourly') == {midnight - 3600: (1.0, 1)}
+    assert buckets('usage_daily') == {'2024-12-31': (1.0, 1)}
+    assert buckets('usage_monthly') == {'2024-12': (1.0, 1)}
+
+
+def test_interval_start_readings_at_midnight_start_the_next_day(sqlite_db):
+    midnight = utc(2024, 12, 31, 23)
+    write_usage([midnight], timezone='Europe/Berlin')
+
+    assert buckets('usage_daily') == {'2025-01-01': (1.0, 1)}
+    assert buckets('usage_monthly') == {'2025-01': (1.0, 1)}
+
+
+def test_overlapping_writes_are_only_counted_once(sqlite_db):
+    start = utc(2025, 6, 1)
+    write_usage(range(start, start + 7200, 900))
+    write_usage(range(start + 3600, start + 10800, 900))
+
+    assert buckets('usage_hourly') == {start: (4.0, 4), start + 3600: (4.0, 4), start + 7200: (4.0, 4)}
+    assert buckets('usage_daily') == {'2025-06-01': (12.0, 12)}
+
+
+def test_rebuild_rollups_matches_the_incremental_rollups(sqlite_db):
+    zone = get_zone('America/New_York')
+    start, end = local_day_bounds(datetime.date(2025, 11, 2), zone)
+    write_usage(range(start, end, 900), timezone='America/New_York', interval_end=True)
+    expected = {table: buckets(table) for table in ('usage_hourly', 'usage_daily', 'usage_monthly')}
+    assert expected['usage_daily']['2025-11-02'] == (99.0, 99)
+
+    with sqlite_db.connection() as conn:
+        for table in expected:
+            conn.execute(f'DELETE FROM {table};')
+        conn.commit()
+    rollups.rebuild_rollups(start - 86400, end + 86400, interval_end=True)
+
+    assert {table: buckets(table) for table in expected} == expected
+
+
+def test_rebuild_rollups_only_rebuilds_whole_hours_from_since(sqlite_db):
+    start = utc(2025, 6, 1)
+    write_usage(range(start, start + 7200, 900))
+    with sqlite_db.connection() as conn:
+        conn.execute('DELETE FROM usage_hourly;')
+        conn.commit()
+
+    rollups.rebuild_rollups(start + 60, start + 7200)
+    assert buckets('usage_hourly') == {start + 3600: (4.0, 4)}
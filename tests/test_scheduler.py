@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import AdaptiveScheduler, RetryableError, parse_retry_after
+
+
+def test_call_retries_retryable_errors_and_backs_off_the_concurrency():
+    scheduler = AdaptiveScheduler(concurrency=4, max_attempts=3, backoff=0)
+    attempts = []
+
+    def flaky():
+        attempts.append(time.time())
+        if len(attempts) < 3:
+            raise RetryableError('server error')
+        return 'ok'
+
+    assert scheduler.call(flaky) == 'ok'
+    assert len(attempts) == 3
+    assert scheduler.concurrency < 4
+
+
+def test_call_raises_the_last_error_after_max_attempts():
+    scheduler = AdaptiveScheduler(max_attempts=2, backoff=0)
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise RetryableError('still failing')
+
+    with pytest.raises(RetryableError):
+        scheduler.call(failing)
+    assert len(calls) == 2
+
+
+def test_call_doesnt_retry_other_errors():
+    scheduler = AdaptiveScheduler(max_attempts=5, backoff=0)
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        scheduler.call(broken)
+    assert len(calls) == 1
+
+
+def test_throttling_halves_only_the_concurrency():
+    scheduler = AdaptiveScheduler(concurrency=8, chunk_size=100, max_attempts=1)
+
+    def throttled():
+        raise RetryableError('429', throttled=True)
+
+    with pytest.raises(RetryableError):
+        scheduler.call(throttled)
+    assert scheduler.concurrency == 4
+    assert scheduler.chunk_size == 100
+
+
+def test_slow_requests_halve_the_chunk_size():
+    scheduler = AdaptiveScheduler(chunk_size=100, min_chunk_size=10, target_latency=0)
+    scheduler.call(time.sleep, 0.01)
+    assert scheduler.chunk_size == 50
+
+
+def test_fast_requests_grow_the_limits_up_to_their_maximums():
+    scheduler = AdaptiveScheduler(concurrency=1, max_concurrency=2, chunk_size=10, max_chunk_size=30, chunk_step=10)
+    for _ in range(10):
+        scheduler.call(lambda: None)
+    assert scheduler.concurrency == 2
+    assert scheduler.chunk_size == 30
+
+
+def test_concurrency_is_shared_by_every_caller():
+    scheduler = AdaptiveScheduler(concurrency=2, max_concurrency=2)
+    lock = threading.Lock()
+    in_flight, peak = [0], [0]
+
+    def request():
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+
+    callers = [threading.Thread(target=lambda: [scheduler.call(request) for _ in range(3)]) for _ in range(4)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert peak[0] == 2
+
+
+def test_a_nested_call_runs_in_its_callers_place():
+    scheduler = AdaptiveScheduler(concurrency=1, max_concurrency=1)
+    assert scheduler.call(lambda: scheduler.call(lambda: 'inner')) == 'inner'
+
+
+def test_map_chunks_yields_every_chunk_in_order():
+    scheduler = AdaptiveScheduler(chunk_size=10, max_chunk_size=10)
+    results = list(scheduler.map_chunks(sum, list(range(25))))
+    assert [chunk for chunk, result in results] == [list(range(10)), list(range(10, 20)), list(range(20, 25))]
+    assert [result for chunk, result in results] == [45, 145, 110]
+
+
+def test_map_chunks_yields_a_failed_chunk_in_place():
+    scheduler = AdaptiveScheduler(chunk_size=10, max_chunk_size=10)
+
+    def fetch(chunk):
+        if 15 in chunk:
+            raise ValueError('no such device')
+        return len(chunk)
+
+    results = [result for chunk, result in scheduler.map_chunks(fetch, list(range(30)))]
+    assert results[0] == results[2] == 10
+    assert isinstance(results[1], ValueError)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('5') == 5
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
@@ -0,0 +1,36 @@
+from partner_api2_pb2 import DataResolution, DeviceUsageRequest
+from vced_stats import split_usage_request
+
+
+def usage_request(device_ids, start, end, scale=DataResolution.FifteenMinutes):
+    request = DeviceUsageRequest()
+    request.manufacturer_device_ids.extend(device_ids)
+    request.start_epoch_seconds = start
+    request.end_epoch_seconds = end
+    request.scale = scale
+    return request
+
+
+def test_split_usage_request_splits_the_devices_first():
+    first, second = split_usage_request(usage_request(['a', 'b', 'c'], 0, 86400))
+    assert list(first.manufacturer_device_ids) == ['a']
+    assert list(second.manufacturer_device_ids) == ['b', 'c']
+    for half in (first, second):
+        assert (half.start_epoch_seconds, half.end_epoch_seconds) == (0, 86400)
+
+
+def test_split_usage_request_splits_one_device_on_a_bucket_boundary():
+    first, second = split_usage_request(usage_request(['a'], 0, 4500))
+    assert (first.start_epoch_seconds, first.end_epoch_seconds) == (0, 1800)
+    assert (second.start_epoch_seconds, second.end_epoch_seconds) == (1800, 4500)
+    assert list(first.manufacturer_device_ids) == list(second.manufacturer_device_ids) == ['a']
+
+
+def test_split_usage_request_uses_minute_buckets_for_minute_resolution():
+    first, second = split_usage_request(usage_request(['a'], 0, 300, DataResolution.Minutes))
+    assert (first.end_epoch_seconds, second.start_epoch_seconds) == (120, 120)
+
+
+def test_split_usage_request_gives_up_on_a_single_bucket():
+    assert split_usage_request(usage_request(['a'], 0, 900)) is None
+    assert split_usage_request(usage_request(['a'], 0, 60, DataResolution.Minutes)) is None
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Tuple
+
+
+class TokenCache:
+    """ Holds an auth token until shortly before it expires, so it can be reused across calls (and,
+    if a path is given, across runs) rather than authenticating every time.
+
+    fetch() is called to get a new token and must return (token, lifetime in seconds). The token is
+    refreshed refresh_margin seconds before it expires. If a path is given, tokens are also stored
+    in that file, keyed by name, and the file is only readable by the current user.
+    """
+
+    def __init__(self, name: str, fetch: Callable[[], Tuple[str, int]], path: str = None, refresh_margin: int = 300):
+        self.name = name
+        self.fetch = fetch
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> str:
+        """ Returns a valid token, authenticating only if the cached one is missing or about to expire. """
+
+        with self._lock:
+            if self._token is None and self.path:
+                self._token, self._expires_at = self._read_file().get(self.name, (None, 0))
+            if self._token is None or time.time() > self._expires_at - self.refresh_margin:
+                token, lifetime = self.fetch()
+                self._token, self._expires_at = token, time.time() + lifetime
+                if self.path:
+                    self._write_file()
+            return self._token
+
+    def invalidate(self, token: str) -> None:
+        """ Drops the given token, for when the server has rejected it. If the token has already been
+        replaced (by another thread seeing the same rejection) this does nothing. """
+
+        with self._lock:
+            if self._token == token:
+                self._token, self._expires_at = None, 0
+                if self.path:
+                    self._write_file()
+
+    def _read_file(self) -> dict:
+        try:
+            with open(self.path, 'r') as cache_file:
+                return {name: (entry['token'], entry['expires_at']) for name, entry in json.load(cache_file).items()}
+        except (OSError, ValueError, KeyError, AttributeError):
+            return {}
+
+    def _write_file(self) -> None:
+        tokens = self._read_file()
+        tokens[self.name] = (self._token, self._expires_at)
+        # Write to a temporary file created with owner-only permissions, then move it into place
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+            json.dump({name: {'token': token, 'expires_at': expires_at}
+                       for name, (token, expires_at) in tokens.items() if token is not None}, cache_file)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,103 @@
+from array import array
+from itertools import repeat
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+# The metadata which is shared by every sample from a circuit
+circuit_columns = ['device_id', 'channel_id', 'channel_type', 'channel_direction']
+# The columns of a usage row, in the order mysql_functions writes them
+row_columns = circuit_columns + ['channel_usage', 'timestamp']
+
+
+class UsageBatch:
+    """ A set of usage samples, stored as parallel arrays rather than a dict per sample. Each sample
+    is a timestamp, a usage value and the index of its circuit in self.circuits, which holds the
+    circuit metadata (device_id, channel_id, channel_type, channel_direction) once per circuit.
+
+    Iterating over a batch yields each sample as a usage dict, in the same form the fetchers used to
+    return, so code expecting a list of dicts keeps working. rows() is cheaper when only some
+    columns are needed in a fixed order.
+
+    fetched_until maps each device the batch was fetched for to the end of the period fetched, whether
+    or not any usage came back for it, so a device with a gap in its data can be moved past the gap.
+    """
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.usages = array('d')
+        self.circuit_indexes = array('l')
+        self.circuits: List[dict] = []
+        self._circuit_positions = {}
+        self.fetched_until: Dict[str, int] = {}
+
+    def add_circuit(self, circuit: dict) -> int:
+        """ Adds a circuit's metadata to the batch if it isn't already there. Returns its index. """
+
+        key = (circuit['device_id'], circuit['channel_id'])
+        position = self._circuit_positions.get(key)
+        if position is None:
+            position = len(self.circuits)
+            self.circuits.append({column: circuit[column] for column in circuit_columns})
+            self._circuit_positions[key] = position
+        return position
+
+    def append(self, circuit_index: int, timestamp: int, usage: float) -> None:
+        self.circuit_indexes.append(circuit_index)
+        self.timestamps.append(timestamp)
+        self.usages.append(usage)
+
+    def add_series(self, circuit: dict, timestamps: Sequence[int], usages: Sequence[float]) -> None:
+        """ Adds a run of samples for one circuit. usages[n] is the usage at timestamps[n]. """
+
+        count = len(usages)
+        self.circuit_indexes.extend(repeat(self.add_circuit(circuit), count))
+        self.timestamps.extend(timestamps[:count])
+        self.usages.extend(usages)
+
+    def mark_fetched(self, device_ids: Iterable[str], until: int) -> None:
+        """ Records that the devices' usage has been fetched up to until. """
+
+        for device_id in device_ids:
+            if until > self.fetched_until.get(device_id, 0):
+                self.fetched_until[device_id] = until
+
+    def extend(self, other: 'UsageBatch') -> None:
+        """ Appends all the samples from another batch. """
+
+        remapped = [self.add_circuit(circuit) for circuit in other.circuits]
+        self.circuit_indexes.extend(remapped[index] for index in other.circuit_indexes)
+        self.timestamps.extend(other.timestamps)
+        self.usages.extend(other.usages)
+        for device_id, until in other.fetched_until.items():
+            self.mark_fetched([device_id], until)
+
+    def rows(self, columns: Sequence[str] = row_columns) -> Iterator[tuple]:
+        """ Yields each sample as a tuple of the requested columns. """
+
+        columns = list(columns)
+        if columns[-2:] == ['channel_usage', 'timestamp']:
+            # The usual case - the circuit columns followed by the usage and timestamp
+            circuit_rows = [tuple(circuit[column] for column in columns[:-2]) for circuit in self.circuits]
+            for circuit_index, timestamp, usage in zip(self.circuit_indexes, self.timestamps, self.usages):
+                yield circuit_rows[circuit_index] + (usage, timestamp)
+        else:
+            for circuit_index, timestamp, usage in zip(self.circuit_indexes, self.timestamps, self.usages):
+                sample = dict(self.circuits[circuit_index], channel_usage=usage, timestamp=timestamp)
+                yield tuple(sample[column] for column in columns)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __iter__(self) -> Iterator[dict]:
+        for row in self.rows():
+            yield dict(zip(row_columns, row))
+
+
+def to_batch(values: Iterable[dict]) -> UsageBatch:
+    """ Builds a UsageBatch from usage dicts. """
+
+    if isinstance(values, UsageBatch):
+        return values
+    batch = UsageBatch()
+    for data in values:
+        batch.append(batch.add_circuit(data), data['timestamp'], data['channel_usage'])
+    return batch
@@ -1,111 +1,487 @@
 #!/usr/bin/env python3
-import csv
-import json
+import argparse
+import contextlib
 import math
 import os
-import pathlib
+import sys
+import threading
 import time
-from io import StringIO
-from typing import List
-
-import grpc
+from typing import Iterator, List
 
+import backfill
+import daemon
+import metrics
 import mysql_functions
-import partner_api2_pb2_grpc as api
-from partner_api2_pb2 import *
+import pipeline
+import rollups
+import sinks
+from inventory_cache import InventoryCache
+from settings import config
+from token_cache import TokenCache
+from usage_batch import UsageBatch
+
+# grpc and the generated protobuf modules are imported by the functions which use them, and the channel,
+# stub and caches are created on first use, so importing this module doesn't touch the network or config
+_stub = None
+_token_cache = None
+_inventory = None
+_clients_lock = threading.Lock()
+# The event loop every asyncio fetch runs on (on its own thread), with its channel's stub and the
+# semaphore limiting the calls in flight on it
+_loop = None
+_aio_stub = None
+_aio_in_flight = None
+
+
+def api_target() -> str:
+    return f"{config['api_root']}:{config['api_port']}"
+
+def open_channel(aio: bool = False):
+    """ Opens a channel to the server (an asyncio one if aio is set), with the channel options from
+    the config: the largest message accepted ('grpc_max_message_mb', default 64), how often idle
+    connections are checked with a keepalive ping ('grpc_keepalive' seconds, default 120) and the
+    compression used ('grpc_compression', 'gzip' by default, or 'none'). """
+
+    import grpc
+
+    options = [('grpc.max_receive_message_length', int(config.get('grpc_max_message_mb', 64) * 2 ** 20)),
+               ('grpc.keepalive_time_ms', int(config.get('grpc_keepalive', 120) * 1000)),
+               ('grpc.keepalive_timeout_ms', 20000)]
+    compression = grpc.Compression.Gzip if config.get('grpc_compression', 'gzip') == 'gzip' else grpc.Compression.NoCompression
+    channels = grpc.aio if aio else grpc
+    if config.get('grpc_insecure', False):
+        # Without TLS, for a local test server such as fake_partner_api.py
+        return channels.insecure_channel(api_target(), options=options, compression=compression)
+    creds = grpc.ssl_channel_credentials()
+    return channels.secure_channel(api_target(), creds, options=options, compression=compression)
+
+def get_stub():
+    """ Returns the blocking client stub, opening the channel to the server on first use. """
+
+    global _stub
+    with _clients_lock:
+        if _stub is None:
+            import partner_api2_pb2_grpc as api
+
+            _stub = api.PartnerApiStub(open_channel())
+    return _stub
+
+def deadline() -> float:
+    """ Returns how many seconds each call may take ('grpc_deadline', default 300). """
+
+    return config.get('grpc_deadline', 300)
+
+def request_auth_token() -> (str, int):
+    """ Authenticates with the API. Returns the auth token and how long it should be reused for. """
+
+    from partner_api2_pb2 import AuthenticationRequest
+
+    request = AuthenticationRequest()
+    request.partner_email = config['username']
+    request.password = config['password']
+    with metrics.timed('auth'):
+        auth_response = get_stub().Authenticate(request=request, timeout=deadline())
+    # The API doesn't say when tokens expire, so they are reused for 'grpc_token_lifetime' seconds, or
+    # until the server rejects them
+    return auth_response.auth_token, config.get('grpc_token_lifetime', 3600)
+
+def get_token_cache() -> TokenCache:
+    """ Returns the cache of the auth token, which is reused until it expires, and optionally kept on
+    disk between runs. """
+
+    global _token_cache
+    with _clients_lock:
+        if _token_cache is None:
+            _token_cache = TokenCache(f"grpc:{config['username']}", request_auth_token, config.get('token_cache_path'))
+    return _token_cache
+
+def call_with_auth(rpc, rpc_request):
+    """ Makes a blocking call with the cached auth token and the per-call deadline. If the token is
+    rejected, authenticates again and retries the call once. """
+
+    import grpc
+
+    token_cache = get_token_cache()
+    rpc_request.auth_token = token_cache.get()
+    try:
+        return rpc(rpc_request, timeout=deadline())
+    except grpc.RpcError as err:
+        if err.code() != grpc.StatusCode.UNAUTHENTICATED:
+            raise
+        token_cache.invalidate(rpc_request.auth_token)
+        rpc_request.auth_token = token_cache.get()
+        return rpc(rpc_request, timeout=deadline())
+
+def should_split(err) -> bool:
+    """ Returns whether a failed usage request should be split up: when the response was larger than
+    the most a channel accepts, or didn't arrive before the deadline. RESOURCE_EXHAUSTED is also
+    used for rate limiting, which splitting wouldn't help. """
+
+    import grpc
+
+    if err.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+        return True
+    return err.code() == grpc.StatusCode.RESOURCE_EXHAUSTED and 'larger than max' in (err.details() or '')
+
+def split_usage_request(usage_request):
+    """ Splits a DeviceUsageRequest in two: by its devices if it has more than one, otherwise by its
+    time range, on a bucket boundary. Returns None if it can't be split any further. """
+
+    from partner_api2_pb2 import DataResolution, DeviceUsageRequest
+
+    halves = (DeviceUsageRequest(), DeviceUsageRequest())
+    for half in halves:
+        half.CopyFrom(usage_request)
+    device_ids = list(usage_request.manufacturer_device_ids)
+    if len(device_ids) > 1:
+        middle = len(device_ids) // 2
+        for half, half_device_ids in zip(halves, (device_ids[:middle], device_ids[middle:])):
+            del half.manufacturer_device_ids[:]
+            half.manufacturer_device_ids.extend(half_device_ids)
+        return halves
+
+    bucket_seconds = 60 if usage_request.scale == DataResolution.Minutes else 900
+    start, end = usage_request.start_epoch_seconds, usage_request.end_epoch_seconds
+    middle = (start + end) // 2
+    middle -= middle % bucket_seconds
+    if middle <= start:
+        middle += bucket_seconds
+    if middle >= end:
+        return None
+    halves[0].end_epoch_seconds = middle
+    halves[1].start_epoch_seconds = middle
+    return halves
+
+def report_split(usage_request, err) -> None:
+    print(f'Splitting the usage request for {len(usage_request.manufacturer_device_ids)} device(s) from '
+          f'{usage_request.start_epoch_seconds} to {usage_request.end_epoch_seconds} in two: {err.code().name} '
+          f'{err.details()}', file=sys.stderr)
+    metrics.inc('emporia_request_splits_total', reason=err.code().name)
+
+def get_usage_data(usage_request) -> list:
+    """ Calls GetUsageData. If the response is too large or too slow (see should_split()), the request
+    is split in half and each half fetched in turn, splitting again as needed. Returns the
+    DeviceUsages. """
+
+    import grpc
+
+    try:
+        with metrics.timed('usage'):
+            usage_response = call_with_auth(get_stub().GetUsageData, usage_request)
+    except grpc.RpcError as err:
+        halves = split_usage_request(usage_request) if should_split(err) else None
+        if halves is None:
+            raise
+        report_split(usage_request, err)
+        return get_usage_data(halves[0]) + get_usage_data(halves[1])
+    metrics.inc('emporia_bytes_received_total', usage_response.ByteSize(), stage='usage')
+    return list(usage_response.device_usages)
+
+def fetch_inventory() -> List[dict]:
+    """ Gets the circuits of all the devices managed by the partner, with the circuit info in the
+    form it is stored alongside the usage. """
+
+    from partner_api2_pb2 import DeviceInventoryRequest
+
+    inventoryRequest = DeviceInventoryRequest()
+    with metrics.timed('inventory'):
+        inventoryResponse = call_with_auth(get_stub().GetDevices, inventoryRequest)
+    metrics.inc('emporia_bytes_received_total', inventoryResponse.ByteSize(), stage='inventory')
+
+    circuits = []
+    # Get the list of active vue2 (1) and vue3 (7) devices. (See partner_api2.proto lines 105-122)
+    for vue2 in [dev for dev in inventoryResponse.devices if dev.model in [1,7]]:
+        for channel in vue2.circuit_infos:
+            info = {'device_id': vue2.manufacturer_device_id, 'channel_id': channel.channel_number, 'channel_direction': channel.energy_direction,
+                    'timezone': vue2.timezone or 'UTC'}
+            if channel.channel_number < 4:
+                info['channel_type'] = 'Mains'
+            else:
+                info['channel_type'] = channel.sub_type
+            if info['channel_type'] == '':
+                info['channel_type'] = 'Unspecified/Unknown'
+            circuits.append(info)
+    return circuits
+
+def get_inventory() -> InventoryCache:
+    """ Returns the cache of the device inventory, which is only fetched again once it expires, or if
+    usage shows up for an unknown circuit. """
 
-# Load the config
-config_path = os.path.normpath(os.path.join(pathlib.Path(__file__).parent.resolve(), 'config.json'))
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
+    global _inventory
+    with _clients_lock:
+        if _inventory is None:
+            _inventory = InventoryCache(f"grpc:{config['username']}", fetch_inventory, config.get('inventory_cache_path'),
+                                        config.get('inventory_cache_ttl', 86400), config.get('inventory_refresh_interval', 600))
+    return _inventory
 
-# Establish a connection to the server...
-creds = grpc.ssl_channel_credentials()
-channel = grpc.secure_channel(f"{config['api_root']}:{config['api_port']}", creds)
-# client stub (blocking)
-stub = api.PartnerApiStub(channel)
+def run_async(coroutine):
+    """ Runs a coroutine on the process's event loop, starting the loop on its own thread the first
+    time, and returns its result. Every thread's asyncio fetches share the one loop, and so the one
+    channel (see get_aio_stub()). """
 
-request = AuthenticationRequest()
-request.partner_email = config['username']
-request.password = config['password']
-auth_response = stub.Authenticate(request=request)
+    import asyncio
 
-auth_token = auth_response.auth_token
+    global _loop
+    with _clients_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='grpc-aio', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
 
-# get list of devices managed by partner
-inventoryRequest = DeviceInventoryRequest()
-inventoryRequest.auth_token = auth_token
-inventoryResponse = stub.GetDevices(inventoryRequest)
+def get_aio_stub():
+    """ Returns the asyncio client stub, and the semaphore which keeps its calls in flight to
+    'grpc_concurrency' (default 4), opening the channel on first use. Only called on the event
+    loop's thread. """
 
-# Get the list of active vue2 (1) and vue3 (7) devices. (See partner_api2.proto lines 105-122)
-devices = [dev for dev in inventoryResponse.devices if dev.model in [1,7]]
+    global _aio_stub, _aio_in_flight
+    if _aio_stub is None:
+        import asyncio
+        import partner_api2_pb2_grpc as api
 
-def store_detailed_usage(since: int, until: int = None) -> List[dict]:
+        _aio_stub = api.PartnerApiStub(open_channel(aio=True))
+        _aio_in_flight = asyncio.Semaphore(config.get('grpc_concurrency', 4))
+    return _aio_stub, _aio_in_flight
+
+async def fetch_usage_async(usage_request, device_ids: List[str], allow_partial: bool = True) -> (list, List[str]):
+    """ Fetches the usage described by usage_request for the given devices using the asyncio gRPC API.
+    The devices are split into shards of 'grpc_shard_size' devices (default 100), each fetched with
+    its own GetUsageData call, with up to 'grpc_concurrency' (default 4) calls in flight at once on
+    the process's channel. Like get_usage_data(), a shard whose response is too large or too slow is
+    split in half, and the halves fetched. Must be run on the process's event loop (see run_async()).
+
+    Returns the DeviceUsages from all of the shards, and the IDs of the devices they were fetched
+    for. If a shard fails, it is reported and skipped so the other shards are still returned; those
+    devices are fetched again on the next run. If allow_partial is False, backfill.IncompleteFetchError
+    is raised instead.
+    """
+
+    import asyncio
+    import grpc
+    from partner_api2_pb2 import DeviceUsageRequest
+
+    shard_size = config.get('grpc_shard_size', 100)
+    token_cache = get_token_cache()
+    aio_stub, in_flight = get_aio_stub()
+
+    async def fetch_request(shard_request) -> list:
+        shard_request.auth_token = await asyncio.to_thread(token_cache.get)
+        try:
+            async with in_flight:
+                with metrics.timed('usage'):
+                    try:
+                        shard_response = await aio_stub.GetUsageData(shard_request, timeout=deadline())
+                    except grpc.aio.AioRpcError as err:
+                        if err.code() != grpc.StatusCode.UNAUTHENTICATED:
+                            raise
+                        token_cache.invalidate(shard_request.auth_token)
+                        shard_request.auth_token = await asyncio.to_thread(token_cache.get)
+                        shard_response = await aio_stub.GetUsageData(shard_request, timeout=deadline())
+        except grpc.aio.AioRpcError as err:
+            halves = split_usage_request(shard_request) if should_split(err) else None
+            if halves is None:
+                raise
+            report_split(shard_request, err)
+            first, second = await asyncio.gather(fetch_request(halves[0]), fetch_request(halves[1]))
+            return first + second
+        metrics.inc('emporia_bytes_received_total', shard_response.ByteSize(), stage='usage')
+        return list(shard_response.device_usages)
+
+    async def fetch_shard(shard: List[str]) -> list:
+        shard_request = DeviceUsageRequest()
+        shard_request.CopyFrom(usage_request)
+        shard_request.manufacturer_device_ids.extend(shard)
+        return await fetch_request(shard_request)
+
+    shards = [device_ids[position:position + shard_size] for position in range(0, len(device_ids), shard_size)]
+    shard_results = await asyncio.gather(*[fetch_shard(shard) for shard in shards], return_exceptions=True)
+
+    device_usages, fetched_device_ids = [], []
+    for shard, shard_result in zip(shards, shard_results):
+        if isinstance(shard_result, grpc.RpcError):
+            if not allow_partial:
+                raise backfill.IncompleteFetchError(shard, shard_result) from shard_result
+            print(f'Unable to fetch usage for {len(shard)} device(s), they will be retried next run: {shard_result}',
+                  file=sys.stderr)
+        elif isinstance(shard_result, BaseException):
+            raise shard_result
+        else:
+            device_usages.extend(shard_result)
+            fetched_device_ids.extend(shard)
+    return device_usages, fetched_device_ids
+
+def report_unknown_channels(unknown: set, skipped: int) -> None:
+    if unknown:
+        print(f"Skipped {skipped} usage rows for {len(unknown)} channel(s) missing from the device inventory: "
+              f"{', '.join(f'{device_id} channel {channel_id}' for device_id, channel_id in sorted(unknown))}",
+              file=sys.stderr)
+        metrics.inc('emporia_rows_total', skipped, outcome='skipped')
+
+def usage_to_batch(device_usages) -> UsageBatch:
+    """ Combines the DeviceUsages from GetUsageData with the circuit info from the inventory. Usage for
+    a channel the inventory doesn't know about is reported and left out. """
+
+    to_insert = UsageBatch()
+    inventory = get_inventory()
+    unknown, skipped = set(), 0
+    with metrics.timed('transform'):
+        for usage_data in device_usages:
+            for channel_usage in usage_data.channel_usages:
+                circuit_data = inventory.get_circuit_info(usage_data.manufacturer_device_id, channel_usage.channel)
+                if circuit_data is None:
+                    unknown.add((usage_data.manufacturer_device_id, channel_usage.channel))
+                    skipped += len(channel_usage.usages)
+                    continue
+                # The usages line up with the bucket timestamps
+                to_insert.add_series(circuit_data, usage_data.bucket_epoch_seconds, channel_usage.usages)
+    report_unknown_channels(unknown, skipped)
+    metrics.inc('emporia_rows_total', len(to_insert), outcome='produced')
+    return to_insert
+
+# The name of the DataResolution requested for each 'resolution' config value
+resolutions = {'minutes': 'Minutes', 'fifteen_minutes': 'FifteenMinutes'}
+
+def store_detailed_usage(since: int, until: int = None, device_ids: List[str] = None, allow_partial: bool = True) -> UsageBatch:
     """ Gets usage info for all circuits on all devices. Returns usage for all circuits as a
-    list of a list of dictionaries, with the circuit info combined with usage.
+    UsageBatch, with the circuit info combined with usage.
     (Why didn't they design the API so that you don't have to combine the circuit types
     manually?)
 
-    Gets usage since the most recent timestamp.
+    Gets usage since the most recent timestamp. If device_ids is provided, only those devices
+    are fetched. With 'grpc_async', allow_partial is as for fetch_usage_async(); otherwise any
+    failure raises.
     """
 
+    from partner_api2_pb2 import DataResolution, DeviceUsageRequest
+
     if until is None:
         until = math.ceil(time.time())
 
     usage_request = DeviceUsageRequest()
-    usage_request.auth_token = auth_token
     usage_request.start_epoch_seconds = since
     usage_request.end_epoch_seconds = until
-    usage_request.scale = DataResolution.FifteenMinutes
+    usage_request.scale = DataResolution.Value(resolutions[config.get('resolution', 'fifteen_minutes')])
     usage_request.channels = DeviceUsageRequest.UsageChannel.ALL
-    usage_request.manufacturer_device_ids.extend([_.manufacturer_device_id for _ in devices])
-
-    usage_response = stub.GetUsageData(usage_request)
-
-    def get_circuit_info(manufacturer_id, channel_id):
-        for vue2 in devices:
-            if vue2.manufacturer_device_id == manufacturer_id:
-                for channel in vue2.circuit_infos:
-                    if channel.channel_number == channel_id:
-                        info = {'device_id': manufacturer_id, 'channel_id': channel_id, 'channel_direction': channel.energy_direction}
-                        if channel.channel_number < 4:
-                            info['channel_type'] = 'Mains'
-                        else:
-                            info['channel_type'] = channel.sub_type
-                        if info['channel_type'] == '':
-                            info['channel_type'] = 'Unspecified/Unknown'
-                        return info
-        raise ValueError('Failed to find device or channel - this is probably a mismatch in the API response.')
-
-    to_insert = []
-    for usage_data in usage_response.device_usages:
-        timestamps = {}
-        # Go through the timestamps
-        for position, timestamp in enumerate(usage_data.bucket_epoch_seconds):
-            timestamps[position] = timestamp
-        for channel_usage in usage_data.channel_usages:
-            circuit_data = get_circuit_info(usage_data.manufacturer_device_id, channel_usage.channel)
-            for pos, usage_at_time in enumerate(channel_usage.usages):
-                circuit_copy = circuit_data.copy()
-                circuit_copy['channel_usage'] = usage_at_time
-                circuit_copy['timestamp'] = timestamps[pos]
-                to_insert.append(circuit_copy)
+    if device_ids is None:
+        device_ids = get_inventory().device_ids()
 
-    return to_insert
+    if config.get('grpc_async', False):
+        device_usages, device_ids = run_async(fetch_usage_async(usage_request, device_ids, allow_partial))
+    else:
+        usage_request.manufacturer_device_ids.extend(device_ids)
+        device_usages = get_usage_data(usage_request)
 
+    detailed_usage = usage_to_batch(device_usages)
+    detailed_usage.mark_fetched(device_ids, until)
+    return detailed_usage
 
-if __name__ == "__main__":
-    get_data_since, get_data_until = mysql_functions.get_most_recent_timestamp()
-    detailed_usage = store_detailed_usage(get_data_since, get_data_until)
-
-    # Write results to the DB, if possible, otherwise print as CSV
-    if 'db' not in config or 'user' not in config['db'] or config['db']['user'] == 'changeme':
-        # Render results as CSV
-        csv_file = StringIO()
-        csv_writer = csv.DictWriter(csv_file,
-                                    fieldnames=['device_id', 'channel_id', 'channel_direction', 'channel_type', 'channel_usage', 'timestamp'])
-        csv_writer.writerows(detailed_usage)
-        csv_file.seek(0)
-        print(csv_file.read())
+def iter_detailed_usage(since: int, until: int = None, device_ids: List[str] = None) -> Iterator[UsageBatch]:
+    """ Like store_detailed_usage(), but fetches the devices in shards of 'grpc_shard_size' devices
+    (default 100), 'grpc_concurrency' (default 4) shards at a time, and yields a UsageBatch for each
+    shard in order as it arrives. """
+
+    if device_ids is None:
+        device_ids = get_inventory().device_ids()
+    shard_size = config.get('grpc_shard_size', 100)
+    shards = [device_ids[position:position + shard_size] for position in range(0, len(device_ids), shard_size)]
+    yield from pipeline.ordered_map(lambda shard: store_detailed_usage(since, until, shard), shards,
+                                    config.get('grpc_concurrency', 4))
+
+
+# Where results are written when they aren't going to the DB. Chosen from the command line options (CSV
+# if there is no DB).
+output = None
+
+def write_results(detailed_usage: UsageBatch) -> None:
+    """ Writes results to the DB, if possible, otherwise prints them as CSV (or to the output chosen on
+    the command line). If 'rollups' is set in the config, the rollups are updated after writing to the DB. """
+
+    if output is not None:
+        output.write(detailed_usage)
+        # There's no DB to say where the next fetch should start from
+        mysql_functions.remember_fetched(detailed_usage)
+    else:
+        write_stats = mysql_functions.write_to_db(detailed_usage)
+        print(f"Wrote {write_stats['written']} rows ({write_stats['ignored']} already present, {write_stats['failed']} failed) "
+              f"in {write_stats['seconds']:.1f}s ({write_stats['rows_per_second']:.0f} rows/s)")
+        if config.get('rollups', False):
+            rollup_stats = rollups.update_rollups(detailed_usage, get_inventory().timezones())
+            print(f"Updated the rollups for {rollup_stats['hours']} device hours in {rollup_stats['seconds']:.1f}s")
+
+
+def fetch_new_usage(device_ids, pipelined=False) -> None:
+    """ Fetches each device from where its stored data ends, up to now, and writes the results. """
+    if pipelined:
+        # Each shard of devices is written while the next ones are being fetched
+        def fetch_shards():
+            for (get_data_since, get_data_until), window_device_ids in mysql_functions.get_device_windows(device_ids).items():
+                yield from iter_detailed_usage(get_data_since, get_data_until, window_device_ids)
+        pipeline.run_pipeline(fetch_shards(), write_results, config.get('pipeline_queue_depth', 4))
     else:
-        mysql_functions.write_to_db(detailed_usage)
+        # Devices that need the same period are fetched together
+        detailed_usage = UsageBatch()
+        for (get_data_since, get_data_until), window_device_ids in mysql_functions.get_device_windows(device_ids).items():
+            detailed_usage.extend(store_detailed_usage(get_data_since, get_data_until, window_device_ids))
+        write_results(detailed_usage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fetches usage for all Vue devices from the Emporia Partner API.')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Catch every device up to now in this run, fetching several windows at once.')
+    parser.add_argument('--since', type=int, help='With --backfill, fetch from this epoch timestamp for all devices.')
+    parser.add_argument('--until', type=int, help='With --backfill, fetch up to this epoch timestamp.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Write each shard of devices as it arrives, while the next ones are fetched.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, fetching the new data shortly after every 15 minutes. SIGHUP reloads config.json.')
+    parser.add_argument('--output', default='-', help='Write the CSV to this file rather than to stdout (when there is no DB).')
+    parser.add_argument('--gzip', action='store_true', help='Gzip compress the CSV output. Implied by an --output ending in .gz.')
+    parser.add_argument('--header', action='store_true', help='Include a header row in the CSV output.')
+    parser.add_argument('--parquet', metavar='DIRECTORY',
+                        help='Write the results to Parquet files in this directory, partitioned by date, rather than to the DB or CSV.')
+    parser.add_argument('--partition-by-device', action='store_true', help='With --parquet, also partition by device.')
+    args = parser.parse_args()
+
+    if args.parquet:
+        output = sinks.ParquetSink(args.parquet, partition_by_device=args.partition_by_device)
+    elif not mysql_functions.db_configured():
+        output = sinks.CsvSink(args.output, compress=args.gzip, header=args.header)
+
+    restart = False
+    # The output is closed (flushing and compacting it) however the run ends
+    with output if output is not None else contextlib.nullcontext():
+        # Authenticating and fetching the inventory happen inside metrics.run(), so their failures are counted
+        if args.backfill:
+            with metrics.run(config.get('metrics_textfile')):
+                device_ids = get_inventory().device_ids()
+                if args.since is not None:
+                    device_windows = {(args.since, args.until or math.ceil(time.time())): device_ids}
+                else:
+                    device_windows = mysql_functions.get_device_windows(device_ids, max_window=None)
+
+                failed_windows = []
+                for (get_data_since, get_data_until), window_device_ids in device_windows.items():
+                    failed_windows.extend(backfill.run_backfill(
+                        lambda since, until, ids=window_device_ids: store_detailed_usage(since, until, ids, allow_partial=False),
+                        write_results,
+                        get_data_since, args.until or get_data_until,
+                        config.get('backfill_window', 86400), config.get('backfill_concurrency', 4)))
+                if failed_windows:
+                    print(f'Unable to backfill {len(failed_windows)} window(s). Rerun with --backfill --since '
+                          f'{failed_windows[0][0]} to fetch them again.', file=sys.stderr)
+                    sys.exit(1)
+        elif args.daemon:
+            if config.get('metrics_port'):
+                metrics.serve(config['metrics_port'])
+
+            def cycle():
+                with metrics.run(config.get('metrics_textfile')):
+                    fetch_new_usage(get_inventory().device_ids(), args.pipeline)
+            restart = daemon.run_daemon(cycle, config.get('daemon_interval', 900), config.get('daemon_delay', 60))
+        else:
+            with metrics.run(config.get('metrics_textfile')):
+                fetch_new_usage(get_inventory().device_ids(), args.pipeline)
+
+    if restart:
+        # SIGHUP: start again with the reloaded config.json
+        os.execv(sys.executable, [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:])
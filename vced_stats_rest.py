@@ -1,41 +1,107 @@
 #!/usr/bin/env python3
+import argparse
 import base64
-import csv
+import calendar
+import contextlib
 import datetime
-import json
+import functools
 import logging
 import os
-import pathlib
 import sys
-from io import StringIO
-
-import requests
+import threading
+import time
+from typing import TYPE_CHECKING, Iterator, List
 
+import backfill
+import daemon
+import metrics
 import mysql_functions
+import pipeline
+import rollups
+import scheduler
+import sinks
+from inventory_cache import InventoryCache
+from settings import config
+from token_cache import TokenCache
+from usage_batch import UsageBatch
 
 logger = logging.getLogger("EmporiaSampleClient")
 logger.setLevel(logging.INFO)
-handler = logging.StreamHandler(sys.stdout)
+# stderr, so the messages never end up mixed into CSV written to stdout
+handler = logging.StreamHandler(sys.stderr)
 formatter = logging.Formatter('%(asctime)s: %(levelname)s: %(message)s', datefmt='%H:%M:%S')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-# Load the config
-config_path = os.path.normpath(os.path.join(pathlib.Path(__file__).parent.resolve(), 'config.json'))
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
+if TYPE_CHECKING:
+    import requests
+
+# requests is imported by the functions which use it, and the session and caches are created on first
+# use, so importing this module doesn't touch the network or config
+_session = None
+_token_cache = None
+_inventory = None
+_scheduler = None
+_clients_lock = threading.Lock()
+
+
+def get_session() -> 'requests.Session':
+    """ Returns the session all requests go through, so connections (and their TLS handshakes) are
+    reused. The connection pool is sized to match the most requests the scheduler lets be in flight
+    at once, across all its callers. """
+
+    global _session
+    with _clients_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
 
+            concurrency = max(config.get('rest_concurrency', 4), config.get('rest_max_concurrency', 16))
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+            _session.mount('http://', HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+    return _session
 
-# Timestamp handling code
+
+# Timestamp handling code. The API's timestamps are UTC, in the form 'YYYY-MM-DDTHH:MM:SSZ'.
 def timestamp_to_iso8601(unix_timestamp):
-    dt = datetime.datetime.fromtimestamp(unix_timestamp)
-    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(unix_timestamp))
+
+@functools.lru_cache(maxsize=65536)
 def iso8601_to_timestamp(iso8601_string):
-    dt = datetime.datetime.strptime(iso8601_string, '%Y-%m-%dT%H:%M:%SZ')
+    """ Converts a UTC timestamp from the API to epoch seconds. The fixed format is sliced apart rather
+    than parsed with strptime, and as every circuit of every device in a response shares the same
+    intervals, the results are cached. """
+
+    if len(iso8601_string) == 20 and iso8601_string[19] == 'Z':
+        return calendar.timegm((int(iso8601_string[0:4]), int(iso8601_string[5:7]), int(iso8601_string[8:10]),
+                                int(iso8601_string[11:13]), int(iso8601_string[14:16]), int(iso8601_string[17:19])))
+    # Anything else, such as fractional seconds or an explicit offset
+    dt = datetime.datetime.fromisoformat(iso8601_string)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
     return int(dt.timestamp())
 
+def local_timestamp_to_utc(timestamp):
+    """ Earlier versions parsed the API's timestamps as local time, so on a host which isn't on UTC
+    the readings were stored shifted by its UTC offset. Returns the timestamp a reading stored as
+    timestamp should have had. Only right when run in the time zone the earlier version ran in.
+    Readings from around the clocks changing which the old parse stored at the same timestamp can't
+    be told apart, and only one of them was kept. """
+
+    return calendar.timegm(time.localtime(timestamp))
+
+class AuthenticationError(Exception):
+    """ Raised when no access token can be had from Cognito. """
+
 # To log in
-def authenticate_with_client_credentials():
+def request_access_token() -> (str, int):
+    """ Gets a new access token from Cognito. Returns the token and its lifetime in seconds. Like
+    the API requests, the request is retried by the scheduler if it is rate limited or fails with a
+    server error. Raises AuthenticationError if Cognito doesn't give a token. """
+
+    import requests
+
     cognito_domain, client_id, client_secret = config['cognito_domain'], config['client_id'], config['client_secret']
 
     token_url = f"{cognito_domain}/oauth2/token"
@@ -45,103 +111,375 @@ def authenticate_with_client_credentials():
         'Authorization': f'Basic {auth_header}'
     }
     data = {'grant_type': 'client_credentials'}
+
+    def post() -> 'requests.Response':
+        with metrics.timed('auth'):
+            try:
+                response = get_session().post(token_url, headers=headers, data=data, timeout=config.get('rest_timeout', 300))
+            except (requests.ConnectionError, requests.Timeout) as err:
+                raise scheduler.RetryableError(f'Request to {token_url} failed: {err}') from err
+            raise_if_retryable(response, token_url)
+        return response
+
     try:
-        response = requests.post(token_url, headers=headers, data=data)
+        response = get_scheduler().call(post)
         response.raise_for_status()
         access_token = response.json().get('access_token')
-        if not access_token:
-            logger.error('Failed to get access_token from Cognito response')
-            sys.exit(1)
-        return access_token
-    except requests.RequestException as e:
-        logger.error('Failed to authenticate with Cognito: %s', e)
-        sys.exit(1)
+    except (requests.RequestException, scheduler.RetryableError) as e:
+        raise AuthenticationError(f'Failed to authenticate with Cognito: {e}') from e
+    if not access_token:
+        raise AuthenticationError('Failed to get access_token from Cognito response')
+    return access_token, response.json().get('expires_in', 3600)
+
+def get_scheduler() -> scheduler.AdaptiveScheduler:
+    """ Returns the scheduler which retries the API requests and adapts how many are in flight, and how
+    many devices each asks for, to how the API is coping. It lasts for the life of the process. """
+
+    global _scheduler
+    with _clients_lock:
+        if _scheduler is None:
+            _scheduler = scheduler.AdaptiveScheduler(
+                concurrency=config.get('rest_concurrency', 4), max_concurrency=config.get('rest_max_concurrency', 16),
+                # The API allows at most 100 devices per request
+                chunk_size=config.get('rest_chunk_size', 100), min_chunk_size=config.get('rest_min_chunk_size', 10),
+                max_chunk_size=min(config.get('rest_chunk_size', 100), 100),
+                target_latency=config.get('rest_target_latency', 10), max_attempts=config.get('rest_max_attempts', 5),
+                backoff=config.get('rest_backoff', 1), backoff_cap=config.get('rest_backoff_cap', 60))
+    return _scheduler
+
+def get_token_cache() -> TokenCache:
+    """ Returns the cache of the access token, which is reused until shortly before it expires, and
+    optionally kept on disk between runs. """
+
+    global _token_cache
+    with _clients_lock:
+        if _token_cache is None:
+            _token_cache = TokenCache(f"rest:{config['client_id']}", request_access_token, config.get('token_cache_path'))
+    return _token_cache
+
+def authenticate_with_client_credentials() -> str:
+    """ Returns a valid access token, only authenticating with Cognito if the cached one has expired. """
+
+    return get_token_cache().get()
+
+def raise_if_retryable(response: 'requests.Response', path: str) -> None:
+    """ Raises scheduler.RetryableError if the response is rate limiting (429) or a server error (5xx). """
+
+    if response.status_code == 429 or response.status_code >= 500:
+        raise scheduler.RetryableError(f'{response.status_code} {response.reason} from {path}',
+                                       retry_after=scheduler.parse_retry_after(response.headers.get('Retry-After')),
+                                       throttled=response.status_code == 429)
+
+def api_get(path: str, params: dict = None, stage: str = 'usage') -> 'requests.Response':
+    """ Makes an authenticated GET request to the REST API. If the access token is rejected, a new
+    one is fetched and the request is retried once. The request is timed in the metrics as the
+    given stage.
+
+    Rate limiting (429), server errors (5xx), timeouts and dropped connections raise
+    scheduler.RetryableError, so the scheduler can back off and try again. Any other error status
+    raises requests.HTTPError.
+    """
+
+    import requests
+
+    session = get_session()
+    timeout = config.get('rest_timeout', 300)
+    auth_token = authenticate_with_client_credentials()
+    with metrics.timed(stage):
+        try:
+            r = session.get(config['rest_api_root'] + path, headers={'Authorization': auth_token}, params=params, timeout=timeout)
+            if r.status_code == 401:
+                logger.info('Access token was rejected, authenticating again')
+                get_token_cache().invalidate(auth_token)
+                r = session.get(config['rest_api_root'] + path, headers={'Authorization': authenticate_with_client_credentials()},
+                                params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            raise scheduler.RetryableError(f'Request to {path} failed: {err}') from err
+        raise_if_retryable(r, path)
+        r.raise_for_status()
+    metrics.inc('emporia_bytes_received_total', len(r.content), stage=stage)
+    return r
+
+direction_map = {'UNKNOWN_DIRECTION': 0,
+                 'CONSUMPTION': 1,
+                 'GENERATION': 2,
+                 'BIDIRECTIONAL': 3}
+channel_map = {'Main_1': 1, 'Main_2': 2, 'Main_3': 3}
+
+def circuit_channel_id(circuit_id: str) -> int:
+    """ Converts a REST API circuit ID to the channel ID that is stored. """
+
+    # The +3 normalizes for the mains which used to be 1,2,3
+    return channel_map[circuit_id] if circuit_id in channel_map else int(circuit_id) + 3
+
+def channel_circuit_id(channel_id: int) -> str:
+    """ Converts a stored channel ID back to the REST API circuit ID. """
+
+    return f'Main_{channel_id}' if channel_id <= 3 else str(channel_id - 3)
+
+# The circuits asked for when the inventory doesn't know a device's circuits
+default_circuit_ids = ['Main_1', 'Main_2', 'Main_3'] + [str(number) for number in range(1, 16)]
+
+def fetch_inventory() -> list[dict]:
+    """ Gets the circuits of all the energy monitors on the account, with the circuit info in the
+    form it is stored alongside the usage (plus the multiplier to apply to the usage). """
+
+    devices = get_scheduler().call(lambda: api_get("/v1/partner/devices", stage='inventory')).json()
+    monitor_ids = [_['device_id'] for _ in devices['devices'] if _['category'] == "MONITOR"]
+
+    def fetch_chunk(chunk):
+        # Get the information for each of the monitors
+        r = api_get("/v1/devices/energy-monitors", params={'device_ids': chunk}, stage='inventory')
+        return r.json()['success']
+
+    circuits = []
+    # The scheduler keeps to the API's limit of 100 devices per request. The inventory has to be complete,
+    # so a chunk which still fails after its retries fails the whole fetch.
+    for chunk, chunk_devices in get_scheduler().map_chunks(fetch_chunk, monitor_ids):
+        if isinstance(chunk_devices, Exception):
+            raise chunk_devices
+        for device in chunk_devices:
+            for circuit_data in device['circuits']:
+                # Figure out the circuit type
+                circuit_type = 'Mains' if circuit_data['circuit_type'] == 'MAIN' else circuit_data['circuit_sub_type']
+                if not circuit_type:
+                    circuit_type = 'Unspecified/Unknown'
+
+                circuits.append({'device_id': device['device_id'],
+                                 'channel_id': circuit_channel_id(circuit_data['circuit_id']),
+                                 'channel_type': circuit_type,
+                                 'channel_direction': direction_map[circuit_data['energy_direction']],
+                                 'multiplier': circuit_data['multiplier'],
+                                 'timezone': device.get('timezone') or 'UTC'})
+    return circuits
+
+def get_inventory() -> InventoryCache:
+    """ Returns the cache of the device inventory, which is only fetched again once it expires, or if
+    usage shows up for an unknown circuit. """
+
+    global _inventory
+    with _clients_lock:
+        if _inventory is None:
+            _inventory = InventoryCache(f"rest:{config['client_id']}", fetch_inventory, config.get('inventory_cache_path'),
+                                        config.get('inventory_cache_ttl', 86400), config.get('inventory_refresh_interval', 600))
+    return _inventory
+
+def get_monitor_ids() -> list[str]:
+    """ Returns the device IDs of all the energy monitors on the account. """
+
+    return get_inventory().device_ids()
+
+# The energy_resolution requested for each 'resolution' config value
+energy_resolutions = {'minutes': "MINUTES", 'fifteen_minutes': "FIFTEEN_MINUTES"}
+
+def usages_to_batch(devices: list) -> UsageBatch:
+    """ Converts the devices in a usages response into a UsageBatch, combining the usage with the
+    circuit info from the inventory. Buckets which are still in progress are left out, as is usage
+    for a circuit the inventory doesn't know about (which is reported). """
+
+    results = UsageBatch()
+    inventory = get_inventory()
+    unknown, skipped = set(), 0
+    with metrics.timed('transform'):
+        for device in devices:
+            for circuit in device['circuit_usages']:
+                circuit_data = inventory.get_circuit_info(device['device_id'], circuit_channel_id(circuit['circuit_id']))
+                if circuit_data is None:
+                    unknown.add((device['device_id'], circuit['circuit_id']))
+                    skipped += sum(1 for usage in circuit['usage'] if not usage['partial'])
+                    continue
+                circuit_index = results.add_circuit(circuit_data)
+                for usage in circuit['usage']:
+                    if not usage['partial']:
+                        results.append(circuit_index,
+                                       iso8601_to_timestamp(usage['interval']['end']),
+                                       usage['energy_kwhs'] * 1000 * circuit_data['multiplier'])
+    if unknown:
+        logger.warning('Skipped %d usage rows for %d circuit(s) missing from the device inventory: %s', skipped, len(unknown),
+                       ', '.join(f'{device_id} circuit {circuit_id}' for device_id, circuit_id in sorted(unknown)))
+        metrics.inc('emporia_rows_total', skipped, outcome='skipped')
+    metrics.inc('emporia_rows_total', len(results), outcome='produced')
+    return results
+
+def chunk_circuit_ids(monitor_ids: List[str]) -> List[str]:
+    """ Returns the circuit IDs to ask for with a chunk of monitors: every circuit the inventory knows
+    of on any of them. """
+
+    channel_ids = get_inventory().channel_ids(monitor_ids)
+    if not channel_ids:
+        return default_circuit_ids
+    return [channel_circuit_id(channel_id) for channel_id in channel_ids]
+
+def iter_usage_during_period(start_timestamp, end_timestamp, monitor_ids: list[str] = None,
+                             allow_partial: bool = True) -> Iterator[UsageBatch]:
+    """ Fetches the usage for the monitors in chunks, and yields a UsageBatch for each chunk of
+    monitors in order as it arrives. If monitor_ids is not provided, usage is fetched for all the
+    monitors on the account.
+
+    The chunks are sized, retried and run concurrently by the scheduler (see get_scheduler()). A
+    chunk which still fails after its retries is reported and left out; as nothing is stored for
+    those monitors, they are fetched again on the next run. Backfills, where later windows move the
+    monitors past the gap, set allow_partial to False to have backfill.IncompleteFetchError raised
+    instead.
+    """
 
-def get_usage_during_period(start_timestamp, end_timestamp) -> list[dict]:
-    """ Returns a list of dictionaries as such:
+    # Get the list of device IDs
+    if monitor_ids is None:
+        monitor_ids = get_monitor_ids()
+
+    def fetch_chunk(chunk):
+        # Get the energy usage
+        r = api_get("/v1/devices/energy-monitors/circuits/usages/energy",
+                    params={'start': timestamp_to_iso8601(start_timestamp),
+                            'end':timestamp_to_iso8601(end_timestamp),
+                            'energy_resolution': energy_resolutions[config.get('resolution', 'fifteen_minutes')],
+                            'device_ids': chunk,
+                            'circuit_ids': chunk_circuit_ids(chunk)})
+        return r.json()['success']
+
+    # The chunks are handed back in order so the output matches a sequential run
+    for chunk, chunk_devices in get_scheduler().map_chunks(fetch_chunk, monitor_ids):
+        if isinstance(chunk_devices, Exception):
+            if not allow_partial:
+                raise backfill.IncompleteFetchError(chunk, chunk_devices) from chunk_devices
+            logger.error('Unable to fetch usage for %d monitor(s), they will be retried next run: %s', len(chunk), chunk_devices)
+            continue
+        chunk_results = usages_to_batch(chunk_devices)
+        chunk_results.mark_fetched(chunk, end_timestamp)
+        yield chunk_results
+
+def get_usage_during_period(start_timestamp, end_timestamp, monitor_ids: list[str] = None,
+                            allow_partial: bool = True) -> UsageBatch:
+    """ Returns a UsageBatch, which iterates as a list of dictionaries as such:
      {'device_id': 'A2034A04B410521CB8CD50',
      'channel_id': 1,
      'channel_direction': 3,
      'channel_type': 'Mains',
      'channel_usage': 91.8388775422838,
      'timestamp': 1743436800}
+
+     If monitor_ids is not provided, usage is fetched for all the monitors on the account.
+     allow_partial is as for iter_usage_during_period().
      """
 
-    # Authenticate and get the list of device IDs
-    auth_token = authenticate_with_client_credentials()
-    devices = requests.get(config['rest_api_root'] + "/v1/partner/devices", headers={'Authorization': auth_token}).json()
-    monitor_ids = [_['device_id'] for _ in devices['devices'] if _['category'] == "MONITOR"]
+    results = UsageBatch()
+    for chunk_results in iter_usage_during_period(start_timestamp, end_timestamp, monitor_ids, allow_partial):
+        results.extend(chunk_results)
+    return results
 
-    monitor_info = {}
 
-    def batch(iterable, size):
-        len_iter = len(iterable)
-        for ndx in range(0, len_iter, size):
-            yield iterable[ndx:min(ndx + size, len_iter)]
+# Where results are written when they aren't going to the DB. Chosen from the command line options (CSV
+# if there is no DB).
+output = None
 
-    # We have to operate on at most 100 at a time due to API restrictions
-    for chunk in batch(monitor_ids, 100):
-        # Get the information for each of the monitors
-        r = requests.get(config['rest_api_root'] + "/v1/devices/energy-monitors",
-                         headers={'Authorization': auth_token}, params={'device_ids': chunk})
-        r.raise_for_status()
-        for device in r.json()['success']:
-            monitor_info[device['device_id']] = device
-            monitor_info[device['device_id']]['circuit_map'] = {_['circuit_id']:_ for _ in device['circuits']}
+def write_results(detailed_usage: UsageBatch) -> None:
+    """ Writes results to the DB, if possible, otherwise prints them as CSV (or to the output chosen on
+    the command line). If 'rollups' is set in the config, the rollups are updated after writing to the DB. """
 
-        # Get the energy usage
-        r = requests.get(config['rest_api_root'] + "/v1/devices/energy-monitors/circuits/usages/energy",
-                              headers={'Authorization': auth_token},
-                              params={'start': timestamp_to_iso8601(start_timestamp),
-                                    'end':timestamp_to_iso8601(end_timestamp),
-                                    'energy_resolution': "FIFTEEN_MINUTES",
-                                    'device_ids': chunk,
-                                    'circuit_ids': ['Main_1', 'Main_2', 'Main_3'] + list(range(1,16))})
-        r.raise_for_status()
-        for device in r.json()['success']:
-            monitor_info[device['device_id']]['circuit_usages'] = device['circuit_usages']
-
-    results = []
-    direction_map = {'UNKNOWN_DIRECTION': 0,
-                     'CONSUMPTION': 1,
-                     'GENERATION': 2,
-                     'BIDIRECTIONAL': 3}
-    channel_map = {'Main_1': 1, 'Main_2': 2, 'Main_3': 3}
-    for device_id, device in monitor_info.items():
-        for circuit in device['circuit_usages']:
-            circuit_data = device['circuit_map'][circuit['circuit_id']]
-            for usage in circuit['usage']:
-                if not usage['partial']:
-                    # The +3 normalizes for the mains which used to be 1,2,3
-                    circuit_id = channel_map[circuit_data['circuit_id']] if circuit_data['circuit_id'] in channel_map else int(circuit_data['circuit_id']) + 3
-                    # Figure out the circuit type
-                    circuit_type = 'Mains' if circuit_data['circuit_type'] == 'MAIN' else circuit_data['circuit_sub_type']
-                    if not circuit_type:
-                        circuit_type = 'Unspecified/Unknown'
-
-                    results.append({'device_id': device_id,
-                                    'channel_id': circuit_id,
-                                    'channel_type': circuit_type,
-                                    'channel_direction': direction_map[circuit_data['energy_direction']],
-                                    'channel_usage': usage['energy_kwhs'] * 1000 * circuit_data['multiplier'],
-                                    'timestamp': iso8601_to_timestamp(usage['interval']['end'])})
+    if output is not None:
+        output.write(detailed_usage)
+        # There's no DB to say where the next fetch should start from
+        mysql_functions.remember_fetched(detailed_usage)
+    else:
+        write_stats = mysql_functions.write_to_db(detailed_usage)
+        logger.info('Wrote %d rows (%d already present, %d failed) in %.1fs (%.0f rows/s)', write_stats['written'],
+                    write_stats['ignored'], write_stats['failed'], write_stats['seconds'], write_stats['rows_per_second'])
+        if config.get('rollups', False):
+            # Each reading is stored at the end of its interval
+            rollup_stats = rollups.update_rollups(detailed_usage, get_inventory().timezones(), interval_end=True)
+            logger.info('Updated the rollups for %d device hours in %.1fs', rollup_stats['hours'], rollup_stats['seconds'])
 
-    return results
+
+def fetch_new_usage(monitor_ids, pipelined=False) -> None:
+    """ Fetches each device from where its stored data ends, up to now, and writes the results. """
+    if pipelined:
+        # Each chunk of monitors is written while the next ones are being fetched
+        def fetch_chunks():
+            for (get_data_since, get_data_until), window_monitor_ids in mysql_functions.get_device_windows(monitor_ids).items():
+                yield from iter_usage_during_period(get_data_since, get_data_until, window_monitor_ids)
+        pipeline.run_pipeline(fetch_chunks(), write_results, config.get('pipeline_queue_depth', 4))
+    else:
+        # Devices that need the same period are fetched together
+        detailed_usage = UsageBatch()
+        for (get_data_since, get_data_until), window_monitor_ids in mysql_functions.get_device_windows(monitor_ids).items():
+            detailed_usage.extend(get_usage_during_period(get_data_since, get_data_until, window_monitor_ids))
+        write_results(detailed_usage)
 
 
 if __name__ == "__main__":
-    get_data_since, get_data_until = mysql_functions.get_most_recent_timestamp()
-    detailed_usage = get_usage_during_period(get_data_since, get_data_until)
-
-    # Write results to the DB, if possible, otherwise print as CSV
-    if 'db' not in config or 'user' not in config['db'] or config['db']['user'] == 'changeme':
-        # Render results as CSV
-        csv_file = StringIO()
-        csv_writer = csv.DictWriter(csv_file,
-                                    extrasaction='ignore',
-                                    fieldnames=['device_id', 'channel_id', 'channel_direction', 'channel_type', 'channel_usage', 'timestamp'])
-        csv_writer.writerows(detailed_usage)
-        csv_file.seek(0)
-        print(csv_file.read())
-    else:
-        mysql_functions.write_to_db(detailed_usage)
+    parser = argparse.ArgumentParser(description='Fetches usage for all energy monitors from the Emporia REST API.')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Catch every device up to now in this run, fetching several windows at once.')
+    parser.add_argument('--since', type=int, help='With --backfill, fetch from this epoch timestamp for all devices.')
+    parser.add_argument('--until', type=int, help='With --backfill, fetch up to this epoch timestamp. With '
+                                                  '--fix-local-timestamps, only correct the readings stored before it.')
+    parser.add_argument('--fix-local-timestamps', action='store_true',
+                        help='Correct the timestamps of the readings stored in the DB by versions which parsed them as '
+                             'local time, then exit. Run it once, in the time zone those versions ran in.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Write each chunk of monitors as it arrives, while the next ones are fetched.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, fetching the new data shortly after every 15 minutes. SIGHUP reloads config.json.')
+    parser.add_argument('--output', default='-', help='Write the CSV to this file rather than to stdout (when there is no DB).')
+    parser.add_argument('--gzip', action='store_true', help='Gzip compress the CSV output. Implied by an --output ending in .gz.')
+    parser.add_argument('--header', action='store_true', help='Include a header row in the CSV output.')
+    parser.add_argument('--parquet', metavar='DIRECTORY',
+                        help='Write the results to Parquet files in this directory, partitioned by date, rather than to the DB or CSV.')
+    parser.add_argument('--partition-by-device', action='store_true', help='With --parquet, also partition by device.')
+    args = parser.parse_args()
+
+    if args.fix_local_timestamps:
+        if not mysql_functions.db_configured():
+            parser.error('--fix-local-timestamps needs the DB to be configured')
+        moved = mysql_functions.correct_timestamps(local_timestamp_to_utc, args.until or int(time.time()))
+        logger.info('Corrected the timestamps of %d readings', moved)
+        sys.exit(0)
+
+    if args.parquet:
+        output = sinks.ParquetSink(args.parquet, partition_by_device=args.partition_by_device)
+    elif not mysql_functions.db_configured():
+        output = sinks.CsvSink(args.output, compress=args.gzip, header=args.header)
+
+    restart = False
+    try:
+        # The output is closed (flushing and compacting it) however the run ends
+        with output if output is not None else contextlib.nullcontext():
+            # Authenticating and fetching the inventory happen inside metrics.run(), so their failures are counted
+            if args.backfill:
+                with metrics.run(config.get('metrics_textfile')):
+                    monitor_ids = get_monitor_ids()
+                    if args.since is not None:
+                        device_windows = {(args.since, args.until or int(time.time())): monitor_ids}
+                    else:
+                        device_windows = mysql_functions.get_device_windows(monitor_ids, max_window=None)
+
+                    failed_windows = []
+                    for (get_data_since, get_data_until), window_monitor_ids in device_windows.items():
+                        failed_windows.extend(backfill.run_backfill(
+                            lambda since, until, ids=window_monitor_ids: get_usage_during_period(since, until, ids, allow_partial=False),
+                            write_results,
+                            get_data_since, args.until or get_data_until,
+                            config.get('backfill_window', 86400), config.get('backfill_concurrency', 4)))
+                    if failed_windows:
+                        logger.error('Unable to backfill %d window(s). Rerun with --backfill --since %d to fetch them again.',
+                                     len(failed_windows), failed_windows[0][0])
+                        sys.exit(1)
+            elif args.daemon:
+                if config.get('metrics_port'):
+                    metrics.serve(config['metrics_port'])
+
+                def cycle():
+                    with metrics.run(config.get('metrics_textfile')):
+                        fetch_new_usage(get_monitor_ids(), args.pipeline)
+                restart = daemon.run_daemon(cycle, config.get('daemon_interval', 900), config.get('daemon_delay', 60))
+            else:
+                with metrics.run(config.get('metrics_textfile')):
+                    fetch_new_usage(get_monitor_ids(), args.pipeline)
+    except AuthenticationError as err:
+        # The daemon carries on past a failure to authenticate, but a single run can't
+        logger.error('%s', err)
+        sys.exit(1)
+
+    if restart:
+        # SIGHUP: start again with the reloaded config.json
+        os.execv(sys.executable, [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:])